@@ -0,0 +1,201 @@
+"""
+Offline throughput benchmarks, no network or API key needed.
+
+    python -m benchmarks.bench --out bench_results.json
+
+Street View is replaced by StubRequests (synthetic panos and noise JPEGs), so the numbers
+cover our own code plus YOLO. Results are written as JSON for comparing between versions.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+
+import cv2
+import gymnasium as gym
+import numpy as np
+import torch
+
+from settings import S
+
+# Keep the run self contained: no caches, no stores, no prefetching, logs in a temp dir
+S.use_cache = False
+S.use_feature_store = False
+S.prefetch = False
+S.save_screenshots = False
+S.log_dir = tempfile.mkdtemp(prefix="bench_") + "/"
+
+from resources.streetview import StreetView, Requests, Pic, FRAME_DIMS
+from resources.loader import StopLoader
+from resources.stop import Stop
+from resources.logging import LogManager
+from resources.custom_policies import StopFeatureExtractor
+from resources.profiling import percentiles
+from rl import StreetViewEnv
+
+class StubRequests(Requests):
+    """ Synthetic Street View: a pano every ~10m, a fixed street bearing, noise images per view. """
+
+    def __init__(self, pic_dims, grid=1e-4):
+        super().__init__(None, pic_dims, use_cache=False)
+        self.grid = grid
+
+    def old_pull_img(self, pic: Pic):
+        # Same view, same image
+        _, _, key = self.image_key(pic)
+        rng = np.random.default_rng(zlib.crc32(key.encode()))
+        img = rng.integers(0, 256, (self.pic_height, self.pic_len, 3), dtype=np.uint8)
+        return cv2.imencode(".jpg", img)[1].tobytes()
+
+    def _metadata(self, pic: Pic):
+        if pic.pano_id:
+            cell_lat, cell_lng = map(int, pic.pano_id.split("_")[1:])
+        else:
+            cell_lat, cell_lng = round(pic.lat / self.grid), round(pic.lng / self.grid)
+        return {
+            "pano_id": f"stub_{cell_lat}_{cell_lng}",
+            "location": {"lat": cell_lat * self.grid, "lng": cell_lng * self.grid},
+            "date": "2024-01",
+        }
+
+    def pull_street_dir(self, lat, lng):
+        return 90.0
+
+def make_stub_env(num_stops):
+    # Stops scattered around midtown Atlanta
+    rng = np.random.default_rng(0)
+    stops = [Stop(33.78 + rng.uniform(-.02, .02), -84.39 + rng.uniform(-.02, .02), f"Bench stop {i}", None, True, None)
+             for i in range(num_stops)]
+
+    sv = StreetView()
+    sv.reqs = StubRequests(FRAME_DIMS)
+    loader = StopLoader(sv, False)
+    loader.stops = stops
+    env = StreetViewEnv(sv, loader)
+    loader.stop_detector = env.stop_detector
+    return env
+
+def summarize(secs):
+    secs = np.array(secs) * 1000
+    return {"mean_ms": float(secs.mean()), "p50_ms": float(np.percentile(secs, 50)),
+            "p95_ms": float(np.percentile(secs, 95)), "n": len(secs)}
+
+def bench_env(env, steps):
+    # Resets
+    reset_times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        env.reset()
+        reset_times.append(time.perf_counter() - start)
+
+    # Random steps, resetting whenever an episode ends
+    step_times = []
+    rng = np.random.default_rng(0)
+    for _ in range(steps):
+        start = time.perf_counter()
+        _, _, done, _, _ = env.step(int(rng.integers(len(S.action_map))))
+        step_times.append(time.perf_counter() - start)
+        if done:
+            env.reset()
+
+    return {
+        "reset": summarize(reset_times),
+        "resets_per_sec": len(reset_times) / sum(reset_times),
+        "step": summarize(step_times),
+        "steps_per_sec": len(step_times) / sum(step_times),
+        "stages_ms": {name: dict(zip(("p50", "p95", "p99"), map(float, p)))
+                      for name, p in percentiles(env.stage_timings()).items()},
+    }
+
+def bench_detector(detector, iters):
+    rng = np.random.default_rng(1)
+    imgs = [rng.integers(0, 256, (640, 640, 3), dtype=np.uint8) for _ in range(4)]
+
+    # Warm up, then time each piece on its own
+    for img in imgs:
+        detector.run(img)
+    run_times, extract_times = [], []
+    for i in range(iters):
+        start = time.perf_counter()
+        output = detector.run(imgs[i % len(imgs)])
+        run_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        detector.extract_features(output)
+        extract_times.append(time.perf_counter() - start)
+    return {"run": summarize(run_times), "extract_features": summarize(extract_times)}
+
+def bench_feature_extractor(batch_size, iters):
+    space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=(S.stack_sz * S.frame_dim,), dtype=np.float32)
+    extractor = StopFeatureExtractor(space).eval()
+    obs = torch.randn(batch_size, S.stack_sz * S.frame_dim)
+
+    with torch.no_grad():
+        extractor(obs)
+        start = time.perf_counter()
+        for _ in range(iters):
+            extractor(obs)
+        secs = time.perf_counter() - start
+    return {"batch_size": batch_size, "obs_per_sec": batch_size * iters / secs, "batch_ms": secs / iters * 1000}
+
+def bench_log_flush(records, flush_every):
+    manager = LogManager(flush_every=10**9, flush_interval=3600)
+    stop = SimpleNamespace(place_name="Bench stop", og_lat=33.78, og_lng=-84.39, members=None)
+    episode = SimpleNamespace(stop=stop, amenity_scores={"sign": .9, "shelter": .5}, reward=1.234, steps=20)
+
+    # Time the flushes alone, at a fixed batch size, as the file grows
+    flush_times = []
+    for i in range(records):
+        manager.add(episode)
+        if (i + 1) % flush_every == 0:
+            start = time.perf_counter()
+            manager._flush_to_disk()
+            flush_times.append(time.perf_counter() - start)
+    manager.shutdown()
+
+    # First vs last tenth shows whether flushes slow down as the log grows
+    tenth = max(len(flush_times) // 10, 1)
+    return {"flush": summarize(flush_times), "records_per_flush": flush_every,
+            "first_tenth_mean_ms": float(np.mean(flush_times[:tenth]) * 1000),
+            "last_tenth_mean_ms": float(np.mean(flush_times[-tenth:]) * 1000)}
+
+def version_info():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "torch": torch.__version__,
+            "platform": platform.platform(), "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline StreetViewEnv / detector / policy benchmarks")
+    parser.add_argument("--out", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--steps", type=int, default=200, help="Env steps to time")
+    parser.add_argument("--detector-iters", type=int, default=50)
+    parser.add_argument("--policy-iters", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--log-records", type=int, default=5000)
+    args = parser.parse_args()
+
+    env = make_stub_env(num_stops=50)
+    results = {
+        "version": version_info(),
+        "settings": {"stack_sz": S.stack_sz, "frame_dim": S.frame_dim, "img_size": list(S.img_size)},
+        "detector": bench_detector(env.stop_detector, args.detector_iters),
+        "env": bench_env(env, args.steps),
+        "feature_extractor": bench_feature_extractor(args.batch_size, args.policy_iters),
+        "log_manager": bench_log_flush(args.log_records, flush_every=5),
+    }
+    env.close()
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import threading
+import time
+from hashlib import sha1
+from pathlib import Path
+from resources.misc import Misc
+from settings import S
+
+class SQLiteStore:
+    """ Base for the on-disk caches. One connection per thread, WAL so several processes can share it. """
+    schema = ""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+        # Build tables up front
+        with self._conn() as conn:
+            conn.executescript(self.schema)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+class ImageCache(SQLiteStore):
+    """
+    Content-addressed JPEG store. The index maps a view key to the digest of the image bytes,
+    the bytes themselves live once per digest under {root}/{digest[:2]}/{digest}.jpg.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS images (
+            key TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS images_last_used ON images(last_used);
+        CREATE INDEX IF NOT EXISTS images_digest ON images(digest);
+    """
+
+    def __init__(self, root=None, max_mb=None):
+        self.root = Path(root or f"{S.cache_dir}/images")
+        self.max_bytes = int((max_mb or S.image_cache_mb) * 1024 * 1024)
+        self._puts = 0
+        super().__init__(self.root / "index.db")
+
+    @staticmethod
+    def key(pic, fov, size):
+        """ (pano_id, quantized heading, fov, size). Falls back to coords if pano isn't known yet. """
+        where = pic.pano_id or pic.get_coords()
+        heading = quantize_heading(pic.heading)
+        return f"{where}|{heading}|{fov}|{size}"
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute("SELECT digest FROM images WHERE key = ?", (key,)).fetchone()
+        if row:
+            try:
+                content = self._blob_path(row[0]).read_bytes()
+            except FileNotFoundError:
+                # Another process evicted it between lookup and read
+                row = None
+        if not row:
+            self.misses += 1
+            return None
+
+        # Touch for LRU
+        conn.execute("UPDATE images SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return content
+
+    def put(self, key, content: bytes):
+        # Write blob atomically, identical images share a file
+        digest = sha1(content).hexdigest()
+        path = self._blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            os.replace(tmp, path)
+
+        conn = self._conn()
+        conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                     (key, digest, len(content), time.time()))
+
+        # Checking the cap means a full scan, so only do it every so often
+        self._puts += 1
+        if self._puts % 64 == 0:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        """ Drop least recently used keys until we're under the size cap. """
+        # Sum over distinct blobs, since that's what is actually on disk
+        total = conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM images GROUP BY digest)"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for key, digest, size in conn.execute(
+                    "SELECT key, digest, size FROM images ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM images WHERE key = ?", (key,))
+
+                # Only remove the blob once nothing points at it
+                if not conn.execute("SELECT 1 FROM images WHERE digest = ?", (digest,)).fetchone():
+                    self._blob_path(digest).unlink(missing_ok=True)
+                    total -= size
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _blob_path(self, digest):
+        return self.root / digest[:2] / f"{digest}.jpg"
+
+def quantize_heading(heading):
+    """ Snap a heading onto the cache's grid, normalized to [0, 360). """
+    if heading is None:
+        return None
+    step = S.heading_quantum
+    return round((heading % 360) / step) * step % 360
+
+class MetaCache(SQLiteStore):
+    """
+    Pano metadata, indexed both by pano_id and by the lat/lng grid cell a location query was made from.
+    A cell pointing at NULL means Google returned ZERO_RESULTS there.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS panos (
+            pano_id TEXT PRIMARY KEY,
+            lat REAL NOT NULL,
+            lng REAL NOT NULL,
+            date TEXT
+        );
+        CREATE TABLE IF NOT EXISTS locations (
+            cell TEXT PRIMARY KEY,
+            pano_id TEXT
+        );
+    """
+
+    # Returned by lookup() when we have to ask Google
+    MISS = object()
+
+    def __init__(self, path=None):
+        super().__init__(path or f"{S.cache_dir}/metadata.db")
+
+    @staticmethod
+    def cell(lat, lng):
+        """ Quantize a location query onto the S.meta_grid grid. """
+        return f"{round(lat / S.meta_grid)}:{round(lng / S.meta_grid)}"
+
+    def lookup(self, pic):
+        """ Returns the metadata dict, None for a known dead spot, or MISS. """
+        conn = self._conn()
+        if pic.pano_id:
+            pano_id = pic.pano_id
+        else:
+            row = conn.execute("SELECT pano_id FROM locations WHERE cell = ?",
+                               (self.cell(pic.lat, pic.lng),)).fetchone()
+            if row is None:
+                self.misses += 1
+                return self.MISS
+
+            # Negative hit
+            if row[0] is None:
+                self.hits += 1
+                return None
+            pano_id = row[0]
+
+        row = conn.execute("SELECT pano_id, lat, lng, date FROM panos WHERE pano_id = ?", (pano_id,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return self.MISS
+        self.hits += 1
+        return {"pano_id": row[0], "location": {"lat": row[1], "lng": row[2]}, "date": row[3]}
+
+    def put(self, pic, meta):
+        """ Store the metadata for a query (meta=None for ZERO_RESULTS). """
+        conn = self._conn()
+        if meta:
+            conn.execute("INSERT OR REPLACE INTO panos VALUES (?, ?, ?, ?)",
+                         (meta["pano_id"], meta["location"]["lat"], meta["location"]["lng"], meta.get("date")))
+
+        # Remember where location queries led, including nowhere
+        if not pic.pano_id:
+            conn.execute("INSERT OR REPLACE INTO locations VALUES (?, ?)",
+                         (self.cell(pic.lat, pic.lng), meta["pano_id"] if meta else None))
+
+class StreetDirCache(SQLiteStore):
+    """
+    Street bearings by geohash cell (S.street_dir_precision). A cell holding NULL means
+    GeoPhotoService had no imagery there.
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS street_dirs (
+            cell TEXT PRIMARY KEY,
+            heading REAL
+        );
+    """
+
+    # Returned by lookup() when we have to ask Google
+    MISS = object()
+
+    def __init__(self, path=None):
+        super().__init__(path or f"{S.cache_dir}/street_dirs.db")
+
+    @staticmethod
+    def cell(lat, lng):
+        return Misc.geohash(lat, lng, S.street_dir_precision)
+
+    def lookup(self, lat, lng):
+        """ Returns the heading, None for a known dead spot, or MISS. """
+        row = self._conn().execute("SELECT heading FROM street_dirs WHERE cell = ?",
+                                   (self.cell(lat, lng),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return self.MISS
+        self.hits += 1
+        return row[0]
+
+    def put(self, lat, lng, heading):
+        self._conn().execute("INSERT OR REPLACE INTO street_dirs VALUES (?, ?)", (self.cell(lat, lng), heading))
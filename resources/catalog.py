@@ -0,0 +1,190 @@
+"""
+Stop catalogs compiled to columns on disk, so loading a national-scale list costs a few mmaps
+instead of a Stop object per row.
+
+    python -m resources.catalog assets/all_stops.csv --ignore assets/done.json
+
+Layout of a compiled catalog directory:
+    lat.npy, lng.npy        float64 coordinates
+    names.bin, name_off.npy UTF-8 string table and its (n + 1) offsets
+    ids.npy                 fixed-width stop IDs (bytes)
+    cells.npy               geohash of each stop (CELL_PRECISION chars, shorter prefixes are coarser cells)
+    flags.npy               uint8 label bits, see FALSE_NEGATIVE / POSITIVE
+    ignored.npy             packed bitmap of stops on the ignore list
+    meta.json               what it was built from, to know when it's stale
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+from resources.misc import Misc
+from resources.stop import Stop
+from settings import S
+
+# Label bits. CSV stops have neither, scored stops have exactly one
+FALSE_NEGATIVE = 1
+POSITIVE = 2
+
+# Longest geohash kept per stop
+CELL_PRECISION = 12
+
+def catalog_dir(path, ignore_path=None):
+    """ Where the compiled version of a stops file (plus ignore list) lives. """
+    tag = Path(path).stem
+    if ignore_path:
+        tag += f"-{Path(ignore_path).stem}"
+    return Path(S.cache_dir) / "catalogs" / tag
+
+def _source_meta(path, ignore_path):
+    meta = {"source": str(path), "source_mtime": os.path.getmtime(path), "ignore": None, "ignore_mtime": None}
+    if ignore_path:
+        meta["ignore"] = str(ignore_path)
+        meta["ignore_mtime"] = os.path.getmtime(ignore_path)
+    return meta
+
+def _read_rows(path, ignored_names):
+    """ (lat, lng, name, stop_id, flags, ignored) for every stop in a CSV or scores JSON. """
+    if path.lower().endswith(".csv"):
+        with open(path, mode="r", newline="", encoding="utf-8") as csvfile:
+            for row in csv.DictReader(csvfile):
+                yield (float(row["latitude"]), float(row["longitude"]), row["name"], row["id"],
+                       0, row["name"] in ignored_names)
+    else:
+        with open(path) as f:
+            scores = json.load(f)
+        for stop_id, score in scores.items():
+            flags = POSITIVE if score["amenity_scores"] else FALSE_NEGATIVE
+
+            # A few scored stops have no Google place name (null), keep them nameless
+            name = score["gmaps_place_name"] or ""
+            yield (score["latitude"], score["longitude"], name, stop_id,
+                   flags, name in ignored_names)
+
+def compile_catalog(path, ignore_path=None, out=None):
+    """ Build the columnar catalog for a stops file. Written to a temp dir and renamed into place. """
+    out = Path(out or catalog_dir(path, ignore_path))
+    ignored_names = set()
+    if ignore_path:
+        with open(ignore_path) as f:
+            ignored_names = {score["place_name"] for score in json.load(f)}
+
+    lats, lngs, ids, cells, flags, ignored = [], [], [], [], [], []
+    names, name_off = bytearray(), [0]
+    for lat, lng, name, stop_id, flag, ignore in _read_rows(path, ignored_names):
+        lats.append(lat)
+        lngs.append(lng)
+        names += name.encode("utf-8")
+        name_off.append(len(names))
+        ids.append(str(stop_id).encode("utf-8"))
+        cells.append(Misc.geohash(lat, lng, CELL_PRECISION).encode())
+        flags.append(flag)
+        ignored.append(ignore)
+
+    tmp = out.with_name(f"{out.name}.{os.getpid()}.tmp")
+    tmp.mkdir(parents=True, exist_ok=True)
+    np.save(tmp / "lat.npy", np.array(lats, dtype=np.float64))
+    np.save(tmp / "lng.npy", np.array(lngs, dtype=np.float64))
+    (tmp / "names.bin").write_bytes(bytes(names))
+    np.save(tmp / "name_off.npy", np.array(name_off, dtype=np.int64))
+    np.save(tmp / "ids.npy", np.array(ids, dtype=bytes))
+    np.save(tmp / "cells.npy", np.array(cells, dtype=f"S{CELL_PRECISION}"))
+    np.save(tmp / "flags.npy", np.array(flags, dtype=np.uint8))
+    np.save(tmp / "ignored.npy", np.packbits(np.array(ignored, dtype=bool)))
+    with open(tmp / "meta.json", "w") as f:
+        json.dump({**_source_meta(path, ignore_path), "count": len(lats)}, f)
+
+    # Swap in the whole build at once, so a half-built dir is never read
+    shutil.rmtree(out, ignore_errors=True)
+    try:
+        os.rename(tmp, out)
+    except OSError:
+        # Another worker got there first with the same sources
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"[Catalog] Compiled {len(lats)} stops from {path} to {out}")
+    return out
+
+class Catalog:
+    """ Read-only, memory-mapped view of a compiled catalog. Rows come out as Stops on demand. """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        load = lambda name: np.load(self.root / f"{name}.npy", mmap_mode="r")
+        self.lat = load("lat")
+        self.lng = load("lng")
+        self.ids = load("ids")
+        self.cells = load("cells")
+        self.flags = load("flags")
+        self.name_off = load("name_off")
+        self.names = np.memmap(self.root / "names.bin", dtype=np.uint8, mode="r") \
+            if self.name_off[-1] else np.zeros(0, dtype=np.uint8)
+        self._ignored = load("ignored")
+
+    @classmethod
+    def open(cls, path, ignore_path=None):
+        """ Open a compiled catalog directory, or the compiled version of a stops file (building it if stale). """
+        if os.path.isdir(path):
+            return cls(path)
+        root = catalog_dir(path, ignore_path)
+        try:
+            with open(root / "meta.json") as f:
+                meta = json.load(f)
+            meta.pop("count")
+            stale = meta != _source_meta(path, ignore_path)
+        except (OSError, ValueError, KeyError):
+            stale = True
+        if stale:
+            compile_catalog(path, ignore_path, root)
+        return cls(root)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def ignored(self):
+        """ Boolean mask of stops on the ignore list. """
+        return np.unpackbits(self._ignored, count=len(self)).astype(bool)
+
+    def name(self, i):
+        return bytes(self.names[self.name_off[i]:self.name_off[i + 1]]).decode("utf-8")
+
+    def stop(self, i):
+        return Stop(float(self.lat[i]), float(self.lng[i]), self.name(i), None,
+                    bool(self.flags[i] & FALSE_NEGATIVE), None, self.ids[i].decode("utf-8"))
+
+    def take(self, idx, members=None):
+        return CatalogStops(self, idx, members)
+
+class CatalogStops:
+    """ A list of stops backed by catalog rows, built as they're asked for. """
+
+    def __init__(self, catalog: Catalog, idx, members=None):
+        self.catalog = catalog
+        self.idx = idx
+        self.members = members or {}
+
+    def __len__(self):
+        return len(self.idx)
+
+    def __getitem__(self, i):
+        if isinstance(i, (slice, np.ndarray)):
+            return CatalogStops(self.catalog, self.idx[i], self.members)
+        return self._stop(self.idx[i])
+
+    def __iter__(self):
+        return (self._stop(row) for row in self.idx)
+
+    def _stop(self, row):
+        stop = self.catalog.stop(row)
+        if row in self.members:
+            stop.members = [self.catalog.stop(member) for member in self.members[row]]
+        return stop
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a stops CSV / scores JSON to a memory-mapped catalog")
+    parser.add_argument("stops", help="Stops CSV or scores JSON")
+    parser.add_argument("--ignore", help="Scores JSON of stops to leave out")
+    parser.add_argument("--out", help="Output directory (defaults to the cache)")
+    args = parser.parse_args()
+    compile_catalog(args.stops, args.ignore, args.out)
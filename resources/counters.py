@@ -0,0 +1,76 @@
+import os
+import json
+import threading
+from atexit import register
+from collections import Counter
+from glob import glob
+from settings import S
+
+class ApiCounter:
+    """
+    In-process API call counts per endpoint (metadata, image, zoomed_image, street_dir), with cache
+    hits counted separately as "<endpoint>_cache_hit". Each process flushes its own file under
+    {S.log_dir}api_calls/ and rewrites the totals over all of them in {S.log_dir}api_calls.json.
+    """
+
+    def __init__(self, flush_interval=S.api_flush_interval):
+        self.flush_interval = flush_interval
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def count(self, name, n=1):
+        # First use in this process (forked workers inherit the parent's counts, drop them)
+        if self.pid != os.getpid():
+            self._start()
+        with self.lock:
+            self.counts[name] += n
+
+    def hit(self, name):
+        self.count(f"{name}_cache_hit")
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.counts = Counter()
+        threading.Thread(target=self._background_flush, daemon=True).start()
+        register(self.flush)
+
+    def _background_flush(self):
+        stopped = threading.Event()
+        while not stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """ Write this process' counts, then refresh the totals. """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            counts = dict(self.counts)
+        write_json(f"{S.log_dir}api_calls/{self.pid}.json", counts)
+        aggregate()
+
+def aggregate(log_dir=None):
+    """ Sum every process' counts into api_calls.json, returns the totals. """
+    log_dir = log_dir or S.log_dir
+    totals = Counter()
+    for path in glob(f"{log_dir}api_calls/*.json"):
+        try:
+            with open(path) as f:
+                totals.update(json.load(f))
+        except (json.JSONDecodeError, FileNotFoundError):
+            continue
+    write_json(f"{log_dir}api_calls.json", dict(totals))
+    return totals
+
+def write_json(path, data):
+    # Write then rename so readers never see half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+api_calls = ApiCounter()
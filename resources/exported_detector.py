@@ -0,0 +1,150 @@
+"""
+Stop detector exported to a single ONNX / TorchScript graph that returns both the raw detection
+head output and the pooled layer-10 features, for CPU boxes without the Ultralytics predictor.
+
+Export (and check against the regular detector on an image):
+    python -m resources.exported_detector --format onnx --check resources/static/frame.jpg
+"""
+import argparse
+import json
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from ultralytics import YOLO
+from ultralytics.engine.results import Results
+from ultralytics.utils import ops
+from resources.preprocess import FramePreprocessor
+from settings import S
+
+def exported_path(fmt=None, precision=None):
+    """ Where the export for a format / precision lives. """
+    fmt = fmt or S.detector_backend
+    precision = precision or S.detector_precision
+    suffix = "_int8" if fmt == "onnx" and precision == "int8" else ""
+    return f"{S.export_path}{suffix}.{fmt}"
+
+def names_path():
+    return f"{S.export_path}.names.json"
+
+class TappedDetector(nn.Module):
+    """ YOLO detection model that also returns the pooled output of layer 10. """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self._tapped = None
+        self.model.model[10].register_forward_hook(self._tap)
+
+    def _tap(self, module, inputs, output):
+        self._tapped = output
+
+    def forward(self, x):
+        preds = self.model(x)
+        if isinstance(preds, (tuple, list)):
+            preds = preds[0]
+        return preds, self._tapped.mean(dim=[2, 3])
+
+class ExportedDetector:
+    """ Runs an exported graph and hands back Ultralytics Results, like YOLO's predictor would. """
+
+    def __init__(self, path=None):
+        path = path or exported_path()
+        with open(names_path()) as f:
+            self.names = {int(i): name for i, name in json.load(f).items()}
+        self.pre = FramePreprocessor()
+
+        # Load the graph for whichever runtime it was exported for
+        if path.endswith(".onnx"):
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if S.detector_threads:
+                options.intra_op_num_threads = S.detector_threads
+            self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+            self._infer = self._infer_onnx
+        else:
+            if S.detector_threads:
+                torch.set_num_threads(S.detector_threads)
+            self.module = torch.jit.load(path, map_location="cpu").eval()
+            self._infer = self._infer_torchscript
+
+    def __call__(self, img):
+        # Same preprocessing as the predictor: letterbox, BGR -> RGB, CHW, 0-1
+        x = self.pre.load(img)
+        preds, feats = self._infer(x)
+
+        # NMS and box scaling straight from Ultralytics so boxes match
+        det = ops.non_max_suppression(torch.from_numpy(preds), S.detector_conf, S.detector_iou, max_det=300)[0]
+        det[:, :4] = ops.scale_boxes(x.shape[2:], det[:, :4], img.shape)
+        results = Results(img, path="", names=self.names, boxes=det)
+        results.pooled_feats = feats[0]
+        return results
+
+    def _infer_onnx(self, x):
+        preds, feats = self.session.run(["preds", "feats"], {"images": x.numpy()})
+        return preds, feats
+
+    def _infer_torchscript(self, x):
+        with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=S.detector_precision == "bf16"):
+            preds, feats = self.module(x)
+        return preds.float().numpy(), feats.float().numpy()
+
+def export(fmt: str, precision: str):
+    """ Export S.yolo_path to S.export_path for the given runtime. """
+    yolo = YOLO(S.yolo_path)
+    model = yolo.model.fuse().eval()
+    for module in model.modules():
+        if hasattr(module, "export"):
+            module.export = True
+    wrapper = TappedDetector(model).eval()
+    dummy = torch.zeros(1, 3, S.img_size[1], S.img_size[0])
+
+    if fmt == "onnx":
+        path = exported_path(fmt, "fp32")
+        torch.onnx.export(wrapper, dummy, path, opset_version=17,
+                          input_names=["images"], output_names=["preds", "feats"],
+                          dynamic_axes={"images": {0: "batch"}, "preds": {0: "batch"}, "feats": {0: "batch"}})
+
+        # Weight-only int8 for CPU
+        if precision == "int8":
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            quantize_dynamic(path, exported_path(fmt, precision), weight_type=QuantType.QUInt8)
+    else:
+        with torch.no_grad():
+            traced = torch.jit.trace(wrapper, dummy, strict=False)
+        traced.save(exported_path(fmt, precision))
+
+    # The graph doesn't carry class names
+    with open(names_path(), "w") as f:
+        json.dump(yolo.names, f)
+    print(f"[Export] Wrote {exported_path(fmt, precision)}")
+
+def check(img_path: str, fmt: str):
+    """ Compare features and boxes from the export with the regular detector on one image. """
+    from resources.stop_detector import StopDetector
+    img = cv2.imread(img_path)
+
+    # Exports only have the tapped features (StopDetector refuses them with legacy), compare like with like
+    S.detector_backend = "ultralytics"
+    S.feature_source = "tapped"
+    ref = StopDetector().detect(img)
+    S.detector_backend = fmt
+    got = StopDetector().detect(img)
+
+    feat_diff = float(np.abs(ref.feats - got.feats).max())
+    print(f"[Export] Max feature diff: {feat_diff:.2e}")
+    print(f"[Export] Boxes: {ref.boxes} (ultralytics) vs {got.boxes} ({fmt})")
+    print(f"[Export] Scores: {ref.conf:.4f} vs {got.conf:.4f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the stop detector for CPU inference")
+    parser.add_argument("--format", choices=["onnx", "torchscript"], default="onnx")
+    parser.add_argument("--precision", choices=["fp32", "int8", "bf16"], default=S.detector_precision,
+                        help="int8 applies to onnx, bf16 to torchscript (at runtime)")
+    parser.add_argument("--check", metavar="IMG", help="Compare against the Ultralytics detector on this image")
+    args = parser.parse_args()
+
+    export(args.format, args.precision)
+    if args.check:
+        S.detector_precision = args.precision
+        check(args.check, args.format)
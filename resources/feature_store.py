@@ -0,0 +1,115 @@
+import os
+import numpy as np
+from hashlib import sha1
+from pathlib import Path
+from resources.cache import SQLiteStore, quantize_heading
+from resources.stop_detector import Detection
+from settings import S
+
+# Width of extract_features' output
+FEATS_DIM = S.features_dim + S.bbs_kept * (S.bb_dim + S.num_classes)
+
+class FeatureStore(SQLiteStore):
+    """
+    Detector output for every view seen so far. Rows live in an append-only float32 file that is
+    memory-mapped for reads, SQLite maps view keys to row numbers.
+
+    Row layout: [feats (FEATS_DIM), conf, found, feats_found, box_sz, per-class conf (NaN if absent),
+                 top boxes (S.screenshot_boxes x [x1, y1, x2, y2, conf, cls], NaN padded)]
+    """
+    schema = """
+        CREATE TABLE IF NOT EXISTS views (
+            key TEXT PRIMARY KEY,
+            row INTEGER NOT NULL UNIQUE
+        );
+    """
+
+    def __init__(self, names: dict, root=None):
+        # Features depend on the weights (and how they're run), so each gets its own store
+        tag = Path(S.yolo_path).stem
+        if S.detector_backend != "ultralytics":
+            tag += f"_{S.detector_backend}_{S.detector_precision}"
+        elif S.feature_source != "legacy":
+            tag += f"_{S.feature_source}"
+
+        # So do the input size, decoding and box thresholds, folded into a short hash
+        inputs = (S.img_size, S.jpeg_decoder, S.reduced_decode, S.detector_conf, S.detector_iou)
+        tag += f"_{sha1(repr(inputs).encode()).hexdigest()[:8]}"
+        root = Path(root or f"{S.cache_dir}/features/{tag}")
+        self.names = names
+        self.label_idx = {label: i for i, label in names.items()}
+        self.boxes_at = FEATS_DIM + 4 + len(names)
+        self.width = self.boxes_at + S.screenshot_boxes * 6
+        self.row_bytes = self.width * 4
+
+        # Row numbers only mean something for one layout, so the index goes with the rows file
+        self.data_path = root / f"rows_{self.width}.f32"
+        super().__init__(root / f"index_{self.width}.db")
+
+        self.fd = os.open(self.data_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.rows = None
+
+    @staticmethod
+    def key(pic):
+        """ A view is a pano (or spot), a heading and a zoom level. """
+        return f"{pic.pano_id or pic.get_coords()}|{quantize_heading(pic.heading)}|{pic.zoom_lvl}"
+
+    def get(self, key):
+        row = self._conn().execute("SELECT row FROM views WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._unpack(self._read(row[0]))
+
+    def put(self, key, det: Detection):
+        packed = self._pack(det)
+        conn = self._conn()
+
+        # Claim a row and fill it before anyone can see it
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM views WHERE key = ?", (key,)).fetchone():
+                conn.execute("ROLLBACK")
+                return
+            row = conn.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM views").fetchone()[0]
+            os.pwrite(self.fd, packed.tobytes(), row * self.row_bytes)
+            conn.execute("INSERT INTO views VALUES (?, ?)", (key, row))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _read(self, row):
+        # Remap when the file has grown past what we mapped
+        if self.rows is None or row >= len(self.rows):
+            n = os.fstat(self.fd).st_size // self.row_bytes
+            self.rows = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(n, self.width))
+        return self.rows[row]
+
+    def _pack(self, det: Detection):
+        packed = np.full(self.width, np.nan, dtype=np.float32)
+        packed[:FEATS_DIM] = det.feats
+        packed[FEATS_DIM:FEATS_DIM + 4] = det.conf, det.found, det.feats_found, det.box_sz
+        for label, conf in (det.boxes or {}).items():
+            packed[FEATS_DIM + 4 + self.label_idx[label]] = conf
+        if det.box_table is not None:
+            table = det.box_table[:S.screenshot_boxes]
+            packed[self.boxes_at:self.boxes_at + table.size] = table.ravel()
+        return packed
+
+    def _unpack(self, packed):
+        conf, found, feats_found, box_sz = packed[FEATS_DIM:FEATS_DIM + 4]
+        class_confs = packed[FEATS_DIM + 4:self.boxes_at]
+        boxes = {self.names[i]: float(c) for i, c in enumerate(class_confs) if not np.isnan(c)}
+        table = packed[self.boxes_at:].reshape(S.screenshot_boxes, 6)
+        table = np.array(table[~np.isnan(table[:, 0])])
+        return Detection(
+            feats=np.array(packed[:FEATS_DIM]),
+            feats_found=bool(feats_found),
+            conf=float(conf),
+            found=bool(found),
+            boxes=boxes or None,
+            box_sz=float(box_sz),
+            box_table=table,
+        )
@@ -0,0 +1,79 @@
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ReadTimeout
+from settings import S
+
+# Statuses worth trying again
+TRANSIENT = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """ Thread-safe token bucket, acquire() blocks only as long as the rate actually requires. """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Unlimited
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                # Refill based on time passed
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                # Take a token if there is one, otherwise figure out how long until there is
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class HttpClient:
+    """ Keep-alive session pool with rate limiting and jittered exponential backoff. """
+
+    def __init__(self, rate=None, burst=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=S.http_pool_size, pool_maxsize=S.http_pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.bucket = TokenBucket(S.requests_per_sec if rate is None else rate,
+                                  S.request_burst if burst is None else burst)
+
+    def get(self, url, **kwargs):
+        """ GET with retries, returns the last response (or raises the last network error). """
+        kwargs.setdefault("timeout", S.request_timeout)
+        for attempt in range(S.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except (ReadTimeout, ConnectionError):
+                if attempt == S.max_retries:
+                    raise
+                self._backoff(attempt)
+                continue
+
+            # Done unless it's something worth retrying
+            if response.status_code not in TRANSIENT or attempt == S.max_retries:
+                return response
+
+            # Respect Retry-After when the server gives one
+            retry_after = response.headers.get("Retry-After")
+            response.close()
+            self._backoff(attempt, float(retry_after) if retry_after and retry_after.isdigit() else None)
+
+    def _backoff(self, attempt, wait=None):
+        # Full jitter: anywhere between 0 and the capped exponential delay
+        if wait is None:
+            wait = random.uniform(0, min(S.backoff_cap, S.backoff_base * 2 ** attempt))
+        print(f"[Retry {attempt + 1}] Waiting {wait:.2f} seconds")
+        time.sleep(wait)
@@ -1,83 +1,187 @@
 from settings import S 
-import json
-from random import sample, shuffle, randint
+import numpy as np
 from resources.stop import Stop
-from resources.stop_detector import StopDetector
-import csv
+from resources.catalog import Catalog, CatalogStops, POSITIVE
+from resources.misc import Misc
+from typing import TYPE_CHECKING
+
+# Only for annotations, so catalog tooling doesn't need YOLO installed
+if TYPE_CHECKING:
+    from resources.stop_detector import StopDetector
 class StopLoader:
 
-    def __init__(self, streetview, scramble_pos=False):
+    def __init__(self, streetview, scramble_pos=False, survey=False):
         self.sv = streetview
         self.index = 0
         self.stops = None
         self.scramble_pos = scramble_pos
-        self.stop_detector: StopDetector = None
-        
-    def load_stops(self, path: str, shuffle_stops = True, num_positives=0, ignore_path: str = None):
-        # Find which stops to ignore if specified
-        if ignore_path: 
-            with open(ignore_path) as f:
-                ignore_f = json.load(f)
-            
-            stops_ignored = []
-            for score_num in ignore_f:
-                stops_ignored.append(score_num["place_name"])
-
-        stops = []
-        # Load stops (CSV)
-        if path.lower().endswith('.csv'):
-            with open(path, mode='r', newline='', encoding='utf-8') as csvfile:
-                
-                # Iterate through stops, creating Stop objects
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    stop = Stop(float(row["latitude"]), float(row["longitude"]),
-                                row["name"], None, False, None)
-
-                    # Ignore if requestted
-                    if ignore_path:
-                        if score["name"] in stops_ignored:
-                            continue
-                    stops.append(stop)
-
-        else:             
-            # Load all stops 
-            with open(path) as f:
-                    scores = json.load(f)
-
-            # Go through stops
-            pos = []
-            for score_num in scores:
-
-                # Build stop 
-                score = scores[score_num]
-                stop = Stop(score["latitude"], score["longitude"], 
-                            score["gmaps_place_name"], None, True, None)
-
-                # Check if this is in the ignore list 
-                if ignore_path:
-                    if score["gmaps_place_name"] in stops_ignored:
-                        continue 
-
-                # Pull out false negatives
-                if len(score['amenity_scores']) == 0:
-                    stops.append(stop)
-                else:
-                    stop.false_negative = False
-                    pos.append(stop)
-
-            # Include positives if requested 
-            if num_positives:
-                stops.extend(sample(pos, num_positives))
+        self.rng = self.scramble_rng = np.random.default_rng()
+
+        # Surveys visit each stop once and then run dry, otherwise stops are reshuffled and reused
+        self.survey = survey
+        self.stop_detector: "StopDetector" = None
         
-        # Shuffle if requested
-        if shuffle_stops:
-            shuffle(stops)
-        self.stops = stops
+    def load_stops(self, path: str, shuffle_stops = True, num_positives=0, ignore_path: str = None,
+                   seed: int = None, shard: tuple = (0, 1), skip_ids: set = None, dedup=False):
+        """
+        Load stops from a CSV, scores JSON or compiled catalog directory (CSV / JSON are compiled
+        on first use, see resources.catalog). With several workers, pass the same seed to each
+        and shard=(rank, num_workers) so they split one shuffled list without overlap.
+        Stops whose IDs are in skip_ids (e.g. already surveyed) are left out. With dedup (surveys),
+        stops within S.dedup_radius of each other and with the same label share one episode.
+        """
+        rng = self.rng = np.random.default_rng(seed)
+
+        # Scrambling differs per worker, but is still fixed by the seed
+        self.scramble_rng = np.random.default_rng(None if seed is None else (seed, shard[0]))
+        catalog = Catalog.open(path, ignore_path)
+
+        # Everything but ignored stops and scored positives
+        keep = ~catalog.ignored()
+        positive = (catalog.flags & POSITIVE).astype(bool)
+        idx = np.flatnonzero(keep & ~positive)
+
+        # Include positives if requested (as many as there are, CSVs have none)
+        pos = np.flatnonzero(keep & positive)
+        if num_positives and len(pos):
+            idx = np.concatenate([idx, rng.choice(pos, min(num_positives, len(pos)), replace=False)])
+
+        # Drop stops that are already done
+        if skip_ids:
+            skip = np.array([str(stop_id).encode("utf-8") for stop_id in skip_ids])
+            idx = idx[~np.isin(catalog.ids[idx], skip)]
+
+        # Stops close enough to land on the same pano get one episode, led by the first of them
+        members = {}
+        if dedup and S.dedup_radius:
+            grouped = []
+
+            # Only stops with the same label can stand in for each other
+            flags = catalog.flags[idx]
+            for flag in np.unique(flags):
+                same = np.flatnonzero(flags == flag)
+                leader = same[self.group_nearby(catalog.lat[idx[same]], catalog.lng[idx[same]], S.dedup_radius)]
+                followers = same[leader != same]
+                for pos, lead in zip(followers, leader[leader != same]):
+                    members.setdefault(idx[lead], []).append(idx[pos])
+                grouped.append(followers)
+
+            # Nothing to group when everything was skipped (a finished survey)
+            if grouped:
+                idx = np.delete(idx, np.concatenate(grouped))
+
+        # Keep only this worker's share, shuffled if requested
+        rank, num_workers = shard
+        if shuffle_stops and S.stop_order == "local":
+            idx = self.local_order(idx, catalog.cells[idx], rng, rank, num_workers)
+        else:
+            if shuffle_stops:
+                idx = rng.permutation(idx)
+            idx = idx[rank::num_workers]
+        self.stops = catalog.take(idx, members)
+
+    @staticmethod
+    def group_nearby(lat, lng, radius):
+        """
+        For each stop, the position of the stop leading its group: walking stops in order, each
+        one that isn't already taken leads every untaken stop within radius metres of it.
+        """
+        n = len(lat)
+        leader = np.arange(n)
+        if n == 0:
+            return leader
+
+        # Grid of cells at least radius wide everywhere, so neighbours are in the 3x3 block around a stop
+        dlat = np.degrees(radius / 6371000)
+        dlng = dlat / max(np.cos(np.radians(np.abs(lat).max())), 1e-6)
+        gy = np.floor(lat / dlat).astype(np.int64)
+        gx = np.floor(lng / dlng).astype(np.int64)
+        cell_key = lambda y, x: (y << 32) + x
+        order = np.argsort(cell_key(gy, gx), kind="stable")
+        sorted_keys = cell_key(gy, gx)[order]
+
+        # Candidate pairs from each neighbouring cell
+        src, dst = [], []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                keys = cell_key(gy + dy, gx + dx)
+                lo = np.searchsorted(sorted_keys, keys, "left")
+                counts = np.searchsorted(sorted_keys, keys, "right") - lo
+                starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                src.append(np.repeat(np.arange(n), counts))
+                dst.append(order[starts + np.arange(counts.sum())])
+        src, dst = np.concatenate(src), np.concatenate(dst)
+
+        # Only actual neighbours, each pair once (earlier stop first)
+        close = src < dst
+        src, dst = src[close], dst[close]
+        close = Misc.haversine(lat[src], lng[src], lat[dst], lng[dst]) <= radius
+        src, dst = src[close], dst[close]
+
+        # Greedy grouping, only stops with a neighbour need looking at
+        by_src = np.argsort(src, kind="stable")
+        src, dst = src[by_src], dst[by_src]
+        bounds = np.searchsorted(src, np.arange(n + 1))
+        taken = np.zeros(n, dtype=bool)
+        for i in np.unique(src):
+            if taken[i]:
+                continue
+            near = dst[bounds[i]:bounds[i + 1]]
+            near = near[~taken[near]]
+            leader[near] = i
+            taken[near] = True
+        return leader
+
+    @staticmethod
+    def local_order(idx, cells, rng, rank=0, num_workers=1):
+        """
+        Shuffle by neighbourhood: stops are bucketed into geohash cells (S.locality_precision),
+        cells come in random order and stops in random order within each cell. Whole cells go to
+        one worker, so each env works through an area while the envs together stay spread out.
+        """
+        # Cells are sorted by np.unique, so every worker draws the same order from the same seed
+        _, cell_of, sizes = np.unique(cells.astype(f"S{S.locality_precision}"),
+                                      return_inverse=True, return_counts=True)
+        cell_rank = np.empty(len(sizes), dtype=np.int64)
+        cell_rank[rng.permutation(len(sizes))] = np.arange(len(sizes))
+
+        # Random order within cells, cells in random order
+        order = rng.permutation(len(idx))
+        order = order[np.argsort(cell_rank[cell_of[order]], kind="stable")]
+
+        # Hand each cell to whichever worker has the fewest stops so far
+        loads = [0] * num_workers
+        mine = np.zeros(len(sizes), dtype=bool)
+        for cell in np.argsort(cell_rank):
+            worker = loads.index(min(loads))
+            loads[worker] += sizes[cell]
+            mine[cell] = worker == rank
+        order = order[mine[cell_of[order]]]
+        return idx[order]
+
+    def exhausted(self):
+        """ True once a survey has handed out every loaded stop (training never runs out). """
+        return self.survey and (self.stops is None or self.index >= len(self.stops))
+
+    def reshuffle(self):
+        """ Start another pass over this worker's stops, in a new order. """
+        order = self.rng.permutation(len(self.stops))
+        if isinstance(self.stops, CatalogStops):
+            self.stops = self.stops[order]
+            if S.stop_order == "local":
+                self.stops = self.stops.catalog.take(
+                    self.local_order(self.stops.idx, self.stops.catalog.cells[self.stops.idx], self.rng),
+                    self.stops.members)
+        else:
+            self.stops = [self.stops[i] for i in order]
+        self.index = 0
 
     def load_stop(self, stop: Stop = None, wiggle_mouse=True):
-        # Automatically pull next stop
+        # Automatically pull next stop, starting over once all have been seen (surveys stop instead)
         if not stop: 
+            if self.index >= len(self.stops) and not self.survey:
+                print("[Stop Loader] All stops visited, reshuffling")
+                self.reshuffle()
             stop = self.stops[self.index]
             self.index += 1 
 
@@ -102,12 +206,12 @@ class StopLoader:
         print("\n[Stop Loader] Scrambling positive stop...")
 
         # Pick a direction to walk in, press key x times
-        action = sample(['w','s'], 1)
-        self.press_loop(action, randint(0, 5))
+        action = self.scramble_rng.choice(['w','s'])
+        self.press_loop(action, self.scramble_rng.integers(0, 6))
 
         # Pick a direction to turn in, press key x times
-        action = sample(['a','d'], 1)
-        self.press_loop(action, randint(0,3))
+        action = self.scramble_rng.choice(['a','d'])
+        self.press_loop(action, self.scramble_rng.integers(0, 4))
 
         # Check if stop is still visible
         img = self.sv.get_img()
@@ -122,8 +226,8 @@ class StopLoader:
             
             # Turn away from the stop
             else:
-                action = sample(['a','d'], 1)
-                self.press_loop(action, randint(0,2))
+                action = self.scramble_rng.choice(['a','d'])
+                self.press_loop(action, self.scramble_rng.integers(0, 3))
         print("[Stop Loader] Complete!\n")
 
     def press_loop(self, action: str, num: int):
@@ -1,70 +1,144 @@
+import fcntl
 import os
-import threading 
+import sys
+import threading
 import json
-import time
+from array import array
 from settings import S
 
 class LogManager:
-    def __init__(self, flush_every=5, flush_interval=100):
-        self.flush_every = flush_every 
+    """
+    Append-only JSON Lines episode log. Each flush is a single O_APPEND write plus the byte offsets
+    of its lines to a sidecar .idx file, under an flock so several worker processes can share both.
+    """
+
+    def __init__(self, flush_every=5, flush_interval=100, fsync_every=S.log_fsync_every):
+        self.flush_every = flush_every
         self.flush_interval = flush_interval
+        self.fsync_every = fsync_every
         self.buffer = []
         self.lock = threading.Lock()
-        self.shutdown_flag = False
-        self.path = f"{S.log_dir}log.json"
+        self.flushes = 0
+        self.stopped = threading.Event()
+        self.path = f"{S.log_dir}log.jsonl"
 
-        # Create directory
+        # Create directory, open both files for appending
         os.makedirs(S.log_dir, exist_ok=True)
-        
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self.fd = os.open(self.path, flags, 0o644)
+        self.idx_fd = os.open(index_path(self.path), flags, 0o644)
+
         # Background thread to flush periodically
         self.flush_thread = threading.Thread(target=self._background_flush, daemon=True)
         self.flush_thread.start()
 
     def add(self, instance):
-        """Add a single episode record to the log buffer."""
-        record = {
-            "place_name": instance.stop.place_name,
-            "latitude": instance.stop.og_lat,
-            "longitude": instance.stop.og_lng,
-            "amenity_scores": instance.amenity_scores,
-            "total_reward": round(instance.reward, 3),
-            "steps_taken": instance.steps
-        }
+        """Add an episode's record to the log buffer, once for its stop and each stop grouped with it."""
+        lines = []
+        for stop in [instance.stop, *(instance.stop.members or [])]:
+            record = {
+                "place_name": stop.place_name,
+                "latitude": stop.og_lat,
+                "longitude": stop.og_lng,
+                "amenity_scores": instance.amenity_scores,
+                "total_reward": round(instance.reward, 3),
+                "steps_taken": instance.steps
+            }
+            lines.append((json.dumps(record) + "\n").encode("utf-8"))
 
         with self.lock:
-            self.buffer.append(record)
-            if len(self.buffer) >= self.flush_every:
-                self._flush_to_disk()
-
-    def _flush_to_disk(self):
-        if not self.buffer:
-            return
+            self.buffer.extend(lines)
+            full = len(self.buffer) >= self.flush_every
+        if full:
+            self._flush_to_disk()
 
+    def _flush_to_disk(self, sync=False):
+        # The only place the lock is held while touching disk, and it's never re-entered
         with self.lock:
-            to_write = self.buffer[:]
-            self.buffer.clear()
+            if not self.buffer or self.fd is None:
+                return
+            data = b"".join(self.buffer)
 
-        if os.path.exists(S.log_dir):
+            # O_APPEND puts our offset at the end of what we just wrote, as long as no other
+            # worker appends in between, hence the file lock
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
             try:
-                with open(self.path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                data = []
-        else:
-            data = []
-
-        data.extend(to_write)
+                os.write(self.fd, data)
+                offset = os.lseek(self.fd, 0, os.SEEK_CUR) - len(data)
+                offsets = array("Q")
+                for line in self.buffer:
+                    offsets.append(offset)
+                    offset += len(line)
+                os.write(self.idx_fd, offsets.tobytes())
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.buffer.clear()
 
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+            # Batch the fsyncs
+            self.flushes += 1
+            if sync or self.flushes % self.fsync_every == 0:
+                os.fsync(self.fd)
+                os.fsync(self.idx_fd)
 
     def _background_flush(self):
-        while not self.shutdown_flag:
-            time.sleep(self.flush_interval)
+        while not self.stopped.wait(self.flush_interval):
             self._flush_to_disk()
 
     def shutdown(self):
         """Gracefully shut down and write any remaining logs."""
-        self.shutdown_flag = True
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
         self.flush_thread.join()
-        self._flush_to_disk()
\ No newline at end of file
+        self._flush_to_disk(sync=True)
+        with self.lock:
+            os.close(self.fd)
+            os.close(self.idx_fd)
+            self.fd = None
+
+def index_path(path):
+    return os.path.splitext(path)[0] + ".idx"
+
+class EpisodeLog:
+    """ Random access reader for a log.jsonl, via its .idx offsets (or a single scan if that's missing). """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, "log.jsonl")
+        self.path = path
+        self.offsets = array("Q")
+        if os.path.exists(index_path(path)):
+            with open(index_path(path), "rb") as f:
+                self.offsets.frombytes(f.read())
+
+            # Workers can land in the index out of file order
+            self.offsets = array("Q", sorted(self.offsets))
+        else:
+            self._scan()
+        self.file = open(path, "rb")
+
+    def _scan(self):
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                self.offsets.append(offset)
+                offset += len(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self.file.seek(self.offsets[i])
+        return json.loads(self.file.readline())
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+if __name__ == "__main__":
+    # python -m resources.logging <run dir or log.jsonl> [episode number]
+    log = EpisodeLog(sys.argv[1])
+    if len(sys.argv) > 2:
+        print(json.dumps(log[int(sys.argv[2])], indent=2))
+    else:
+        print(f"{len(log)} episodes in {log.path}")
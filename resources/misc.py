@@ -1,23 +1,40 @@
 import numpy as np 
 from settings import S
-from cv2 import resize
-from math import radians, sin, cos, sqrt, atan2
 
 class Misc:
-    def preprocess_img(img):
-        """ Resizes, normalizes, and transposes images. """
-        img = resize(img, S.img_size).astype(np.float32) / 255.0
-        img = np.transpose(img, (2, 0, 1))
-        return img 
-
     def haversine(lat1, lon1, lat2, lon2):
-        """ Implementation of the haversine formula to obtain distance from initial to new cords. """
+        """ Implementation of the haversine formula to obtain distance from initial to new cords. Works on arrays too. """
         R = 6371000
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-        return R * 2 * atan2(sqrt(a), sqrt(1 - a))
+        lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+        return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
         
+    def geohash(lat, lon, precision=8):
+        """ Standard base32 geohash of a point, precision 8 is roughly 38m x 19m. """
+        alphabet = "0123456789bcdefghjkmnpqrstuvwxyz"
+        lat_rng, lon_rng = [-90.0, 90.0], [-180.0, 180.0]
+        chars, bits, ch, even = [], 0, 0, True
+        while len(chars) < precision:
+            # Alternate between halving longitude and latitude
+            rng, val = (lon_rng, lon) if even else (lat_rng, lat)
+            mid = (rng[0] + rng[1]) / 2
+            ch <<= 1
+            if val >= mid:
+                ch |= 1
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+
+            # Every 5 bits is a character
+            bits += 1
+            if bits == 5:
+                chars.append(alphabet[ch])
+                bits, ch = 0, 0
+        return "".join(chars)
+
     def announce(instance, key, reward):
         """ Print stop info and action to console at each step. """
         name = instance.stop.place_name
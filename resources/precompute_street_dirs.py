@@ -0,0 +1,61 @@
+"""
+Fill the street-direction cache around every stop in a catalog ahead of training, so fallback
+moves are answered from disk instead of GeoPhotoService.
+
+    python -m resources.precompute_street_dirs assets/all_stops.csv --rings 1
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from resources.cache import StreetDirCache
+from resources.loader import StopLoader
+from resources.streetview import Requests, FRAME_DIMS
+from settings import S
+
+def cell_size(precision):
+    """ (lat, lng) span in degrees of a geohash cell. Longitude gets the odd bit. """
+    bits = 5 * precision
+    lat_bits = bits // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** (bits - lat_bits)
+
+def cells_near(stops, rings):
+    """ One query point per cell within rings cells of any stop. """
+    dlat, dlng = cell_size(S.street_dir_precision)
+    points = {}
+    for stop in stops:
+        for i in range(-rings, rings + 1):
+            for j in range(-rings, rings + 1):
+                lat, lng = stop.og_lat + i * dlat, stop.og_lng + j * dlng
+                points.setdefault(StreetDirCache.cell(lat, lng), (lat, lng))
+    return points
+
+def precompute(path, rings=1, workers=S.prefetch_workers):
+    loader = StopLoader(None)
+    loader.load_stops(path, shuffle_stops=False)
+
+    # Only the street cache matters here, and it's filled even when S.use_cache is off
+    cache = StreetDirCache()
+    reqs = Requests(None, FRAME_DIMS, use_cache=False)
+    reqs.street_cache = cache
+
+    # Only ask about cells we haven't seen
+    points = cells_near(loader.stops, rings)
+    todo = [pt for pt in points.values() if cache.lookup(*pt) is StreetDirCache.MISS]
+    print(f"[Street Dirs] {len(loader.stops)} stops, {len(points)} cells, {len(todo)} to pull")
+
+    found = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reqs.pull_street_dir, lat, lng) for lat, lng in todo]
+        for i, future in enumerate(as_completed(futures), 1):
+            if future.result() is not None:
+                found += 1
+            if i % 500 == 0:
+                print(f"[Street Dirs] {i}/{len(todo)}")
+    print(f"[Street Dirs] Done, {found}/{len(todo)} cells have a street")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute street directions around a stop catalog")
+    parser.add_argument("stops", help="Stops CSV or scores JSON")
+    parser.add_argument("--rings", type=int, default=1, help="Neighbouring cells to cover around each stop")
+    parser.add_argument("--workers", type=int, default=S.prefetch_workers)
+    args = parser.parse_args()
+    precompute(args.stops, args.rings, args.workers)
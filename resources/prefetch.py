@@ -0,0 +1,101 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from settings import S
+
+class Prefetcher:
+    """
+    Warms the image / metadata caches for the views the agent is likely to ask for next,
+    while the detector and policy are busy with the current one.
+    """
+
+    def __init__(self, streetview):
+        self.sv = streetview
+        self.executor = ThreadPoolExecutor(max_workers=S.prefetch_workers, thread_name_prefix="prefetch")
+        self.pending = set()
+        self.generation = 0
+        self.lock = threading.RLock()
+
+    def schedule(self, pic):
+        """ Drop whatever is queued for the old view and queue the neighbours of this one. """
+        self.cancel()
+        with self.lock:
+            generation = self.generation
+
+        # Rotations keep the zoom level, zooming keeps the heading
+        for delta in (S.rotate_amt, -S.rotate_amt):
+            rotated = copy(pic)
+            rotated.heading += delta
+            self._submit(self._pull_image, rotated, generation)
+        if pic.zoom_lvl < 2:
+            zoomed = copy(pic)
+            zoomed.zoom_lvl += 1
+            self._submit(self._pull_image, zoomed, generation)
+
+        # Moves need metadata first to know which pano we'd land on
+        for heading in (pic.heading, pic.heading - 180):
+            self._submit(self._pull_move, (copy(pic), heading), generation)
+
+    def cancel(self):
+        """ Cancel queued work; anything already running sees the new generation and bails early. """
+        with self.lock:
+            self.generation += 1
+
+            # Cancelled futures drop out through _done, running ones still count against the cap
+            for future in list(self.pending):
+                future.cancel()
+
+    def close(self):
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, arg, generation):
+        with self.lock:
+            # Cap how much speculative work can pile up
+            if len(self.pending) >= S.prefetch_max_pending:
+                return
+            future = self.executor.submit(fn, arg, generation)
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _stale(self, generation):
+        return generation != self.generation
+
+    def _pull_image(self, pic, generation):
+        if self._stale(generation):
+            return
+        try:
+            self.sv.reqs.pull_image(pic)
+        except Exception as e:
+            # Speculative, the real request will surface any error
+            if S.request_msgs: print(f"[Prefetch] Image failed: {e}")
+
+    def _pull_move(self, args, generation):
+        pic, heading = args
+        if self._stale(generation):
+            return
+
+        # Same pano lookup _move would do
+        moved = self.sv._offset(pic, heading)
+        try:
+            found = self.sv.reqs.pull_pano_info(moved)
+        except Exception as e:
+            if S.request_msgs: print(f"[Prefetch] Metadata failed: {e}")
+            return
+
+        # Only a new pano gives a predictable image
+        if found and moved.pano_id != pic.pano_id:
+            self._pull_image(moved, generation)
+            return
+
+        # Otherwise _move falls back on the street bearing here
+        if self._stale(generation):
+            return
+        try:
+            self.sv.reqs.pull_street_dir(pic.lat, pic.lng)
+        except Exception as e:
+            if S.request_msgs: print(f"[Prefetch] Street dir failed: {e}")
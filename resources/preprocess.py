@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+import torch
+from settings import S
+
+class FramePreprocessor:
+    """
+    Letterboxes BGR frames straight into one preallocated (batch, 3, h, w) float32 buffer,
+    RGB and 0-1 like the Ultralytics predictor expects. The buffer is pinned when there's a GPU
+    to copy to, and torch / numpy share its memory, so nothing is allocated per frame.
+    """
+
+    def __init__(self, batch=1, size=S.img_size, pad=114):
+        self.width, self.height = size
+        self.pad = pad
+        self.tensor = torch.empty((batch, 3, self.height, self.width), dtype=torch.float32,
+                                  pin_memory=torch.cuda.is_available())
+        self.array = self.tensor.numpy()
+
+        # uint8 staging for the letterboxed frame, resize buffers per input shape
+        self.canvas = np.full((self.height, self.width, 3), pad, dtype=np.uint8)
+        self._resized = {}
+        self._layout = None
+
+    def load(self, img, slot=0):
+        """ Letterbox one frame into a slot of the buffer. """
+        canvas = self._letterbox(img)
+
+        # BGR HWC uint8 -> RGB CHW float 0-1 in one pass, written in place
+        np.multiply(canvas[..., ::-1].transpose(2, 0, 1), np.float32(1 / 255), out=self.array[slot], casting="unsafe")
+        return self.tensor[slot:slot + 1]
+
+    def load_batch(self, imgs):
+        """ Letterbox several frames, returns the (n, 3, h, w) view over them. """
+        for slot, img in enumerate(imgs):
+            self.load(img, slot)
+        return self.tensor[:len(imgs)]
+
+    def _letterbox(self, img):
+        h, w = img.shape[:2]
+        if (h, w) == (self.height, self.width):
+            return img
+
+        # Same rounding as Ultralytics' LetterBox(auto=False) so boxes line up
+        r = min(self.height / h, self.width / w)
+        new_w, new_h = round(w * r), round(h * r)
+        top = round((self.height - new_h) / 2 - .1)
+        left = round((self.width - new_w) / 2 - .1)
+
+        # Only repaint the border when the layout changes
+        if self._layout != (new_h, new_w, top, left):
+            self.canvas[:] = self.pad
+            self._layout = (new_h, new_w, top, left)
+
+        resized = self._resized.get((new_h, new_w))
+        if resized is None:
+            resized = self._resized[(new_h, new_w)] = np.empty((new_h, new_w, 3), dtype=np.uint8)
+        cv2.resize(img, (new_w, new_h), dst=resized, interpolation=cv2.INTER_LINEAR)
+        self.canvas[top:top + new_h, left:left + new_w] = resized
+        return self.canvas
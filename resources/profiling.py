@@ -0,0 +1,80 @@
+import os
+import time
+import threading
+import cProfile
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import numpy as np
+from stable_baselines3.common.callbacks import BaseCallback
+from settings import S
+
+class StageTimer:
+    """
+    Rolling per-stage latencies for the env step. Only the main thread records, so background
+    work (prefetching etc.) doesn't get mixed into the step's numbers.
+    """
+
+    def __init__(self, window=S.timing_window):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, secs):
+        if threading.current_thread() is threading.main_thread():
+            self.samples[name].append(secs)
+
+    def drain(self):
+        """ Hand back everything recorded so far (in seconds) and start over. """
+        samples = {name: list(values) for name, values in self.samples.items()}
+        self.samples.clear()
+        return samples
+
+timings = StageTimer()
+
+def percentiles(samples: dict):
+    """ {stage: [secs]} -> {stage: (p50, p95, p99)} in milliseconds. """
+    return {name: tuple(np.percentile(np.array(values) * 1000, [50, 95, 99]))
+            for name, values in samples.items() if values}
+
+@contextmanager
+def step_profile(step: int):
+    """ Profile every S.profile_every-th step to {S.log_dir}profiles/, a no-op otherwise. """
+    if not S.profile_every or step % S.profile_every:
+        yield
+        return
+
+    os.makedirs(f"{S.log_dir}profiles", exist_ok=True)
+    path = f"{S.log_dir}profiles/step_{os.getpid()}_{step}"
+    if S.profile_backend == "torch":
+        import torch.profiler
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+            yield
+        prof.export_chrome_trace(f"{path}.json")
+    else:
+        with cProfile.Profile() as prof:
+            yield
+        prof.dump_stats(f"{path}.prof")
+
+class TimingCallback(BaseCallback):
+    """ Pulls stage timings out of every env after each rollout and logs p50/p95/p99. """
+
+    def _on_step(self) -> bool:
+        return True
+
+    def _on_rollout_end(self):
+        # Merge the raw samples across envs before taking percentiles
+        merged = defaultdict(list)
+        for samples in self.training_env.env_method("stage_timings"):
+            for name, values in samples.items():
+                merged[name].extend(values)
+
+        for name, (p50, p95, p99) in percentiles(merged).items():
+            self.logger.record(f"latency/{name}_p50_ms", p50)
+            self.logger.record(f"latency/{name}_p95_ms", p95)
+            self.logger.record(f"latency/{name}_p99_ms", p99)
@@ -0,0 +1,104 @@
+import json
+import cv2
+import numpy as np
+from resources.cache import SQLiteStore, MetaCache
+from resources.counters import api_calls
+from resources.streetview import Requests, Pic
+from settings import S
+
+class Archive(SQLiteStore):
+    """ Every metadata, image and street-direction response of a run, in one SQLite file. """
+    schema = """
+        CREATE TABLE IF NOT EXISTS responses (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            body BLOB,
+            PRIMARY KEY (kind, key)
+        );
+    """
+
+    # Returned by get() for keys that were never recorded
+    MISS = object()
+
+    def get(self, kind, key):
+        row = self._conn().execute("SELECT body FROM responses WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+        if row is None:
+            self.misses += 1
+            return self.MISS
+        self.hits += 1
+        return row[0]
+
+    def put(self, kind, key, body):
+        self._conn().execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (kind, key, body))
+
+def meta_key(pic: Pic):
+    return pic.pano_id or MetaCache.cell(pic.lat, pic.lng)
+
+def street_key(lat, lng):
+    return f"{lat:.7f},{lng:.7f}"
+
+class RecordingRequests(Requests):
+    """ Live requests that also write everything the env sees to an archive. """
+
+    def __init__(self, archive_path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.archive = Archive(archive_path)
+
+    def old_pull_img(self, pic: Pic):
+        content = super().old_pull_img(pic)
+        self.archive.put("image", self.image_key(pic)[2], content)
+        return content
+
+    def _metadata(self, pic: Pic):
+        # Key on the query before the pic gets filled in
+        key = meta_key(pic)
+        meta = super()._metadata(pic)
+        self.archive.put("metadata", key, json.dumps(meta))
+        return meta
+
+    def pull_street_dir(self, lat, lng):
+        heading = super().pull_street_dir(lat, lng)
+        self.archive.put("street_dir", street_key(lat, lng), json.dumps(heading))
+        return heading
+
+class ReplayRequests(Requests):
+    """
+    Serves a recorded archive through the Requests interface, never touching the network.
+    Anything that wasn't recorded behaves like an empty spot (no pano, no street, blank frame),
+    is counted as "replay_<kind>_miss" in api_calls and warned about, or raises with S.replay_strict.
+    """
+
+    def __init__(self, archive_path, pic_dims, debug = False):
+        super().__init__(None, pic_dims, debug, use_cache=False)
+        self.archive = Archive(archive_path)
+
+        # Stand-in for unrecorded images
+        blank = np.zeros((self.pic_height, self.pic_len, 3), dtype=np.uint8)
+        self.blank_img = cv2.imencode(".jpg", blank)[1].tobytes()
+
+    def old_pull_img(self, pic: Pic):
+        content = self.archive.get("image", self.image_key(pic)[2])
+        if content is Archive.MISS:
+            self._miss("image", pic.pano_id or pic.get_coords())
+            return self.blank_img
+        return content
+
+    def _metadata(self, pic: Pic):
+        body = self.archive.get("metadata", meta_key(pic))
+        if body is Archive.MISS:
+            self._miss("metadata", pic.pano_id or pic.get_coords())
+            return None
+        return json.loads(body)
+
+    def pull_street_dir(self, lat, lng):
+        body = self.archive.get("street_dir", street_key(lat, lng))
+        if body is Archive.MISS:
+            self._miss("street_dir", (lat, lng))
+            return None
+        return json.loads(body)
+
+    def _miss(self, kind, key):
+        api_calls.count(f"replay_{kind}_miss")
+        if S.replay_strict:
+            raise KeyError(f"[Replay] No recorded {kind} for {key} in {self.archive.path}")
+        print(f"[Replay] No recorded {kind} for {key}")
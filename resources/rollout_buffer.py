@@ -0,0 +1,81 @@
+import numpy as np
+from stable_baselines3.common.buffers import RolloutBuffer
+from stable_baselines3.common.type_aliases import RolloutBufferSamples
+from settings import S
+
+class FrameStackRolloutBuffer(RolloutBuffer):
+    """
+    Rollout buffer for VecFrameStack observations that keeps each frame once.
+
+    Only the newest frame of every step is stored, plus the stack_sz - 1 frames each env had
+    before the rollout began. Stacks are rebuilt by index when minibatches are sampled, zeroing
+    frames from before an episode start exactly like VecFrameStack does, so the policy sees the
+    same (batch, stack_sz * frame_dim) tensor as before at roughly 1 / stack_sz of the memory.
+    """
+
+    def __init__(self, *args, stack_sz=S.stack_sz, **kwargs):
+        self.stack_sz = stack_sz
+        super().__init__(*args, **kwargs)
+
+    def reset(self):
+        # Let the parent allocate its arrays, but with single frames as the observation
+        stacked_shape = self.obs_shape
+        self.frame_dim = stacked_shape[0] // self.stack_sz
+        self.obs_shape = (self.frame_dim,)
+        super().reset()
+        self.obs_shape = stacked_shape
+
+        # Frames each env had stacked before the first step of this rollout
+        self.history = np.zeros((self.n_envs, self.stack_sz - 1, self.frame_dim), dtype=np.float32)
+        self.timeline = None
+        self.floor = None
+
+    def add(self, obs, *args, **kwargs):
+        stack = np.asarray(obs).reshape(self.n_envs, self.stack_sz, self.frame_dim)
+        if self.pos == 0:
+            self.history[:] = stack[:, :-1]
+
+        # Only the newest frame is new information
+        super().add(stack[:, -1], *args, **kwargs)
+
+    def get(self, batch_size=None):
+        if not self.generator_ready:
+            self._build_index()
+        yield from super().get(batch_size)
+
+    def _build_index(self):
+        """ Lay each env's frames out in time order and note where its current episode began. """
+        steps = self.buffer_size
+        frames = self.observations.reshape(steps, self.n_envs, self.frame_dim).swapaxes(0, 1)
+        self.timeline = np.concatenate([self.history, frames], axis=1)
+
+        # Parent still flattens observations in get(), give it nothing to copy
+        self.observations = np.empty((steps, self.n_envs, 0), dtype=np.float32)
+
+        # Most recent episode start at or before each step (-1 if none this rollout)
+        step_idx = np.arange(steps)[:, None]
+        last_start = np.maximum.accumulate(np.where(self.episode_starts > 0, step_idx, -1), axis=0)
+
+        # Earliest timeline position that belongs to the same episode, per (env, step)
+        self.floor = np.where(last_start >= 0, last_start + self.stack_sz - 1, 0).T
+
+    def _get_samples(self, batch_inds, env=None):
+        # Flattened indices are env-major after swap_and_flatten
+        envs = batch_inds // self.buffer_size
+        steps = batch_inds % self.buffer_size
+
+        # Window of stack_sz timeline positions ending at each step, oldest first
+        window = steps[:, None] + np.arange(self.stack_sz)[None, :]
+        obs = self.timeline[envs[:, None], window]
+
+        # Zero out frames from before the episode started
+        obs *= (window >= self.floor[envs, steps][:, None])[:, :, None]
+        data = (
+            obs.reshape(len(batch_inds), -1),
+            self.actions[batch_inds],
+            self.values[batch_inds].flatten(),
+            self.log_probs[batch_inds].flatten(),
+            self.advantages[batch_inds].flatten(),
+            self.returns[batch_inds].flatten(),
+        )
+        return RolloutBufferSamples(*tuple(map(self.to_torch, data)))
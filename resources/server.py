@@ -1,21 +1,87 @@
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 import logging 
+import queue
+import threading
 
 app = Flask(__name__)
 log = logging.getLogger('werkzeug')
 log.disabled = True
+
+class FrameHub:
+    """
+    Latest JPEG from the env, kept in memory. Viewers block until a new one arrives.
+    In an env worker process (num_envs > 1) frames are forwarded to the parent, where the server runs.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.version = 0
+        self.cond = threading.Condition()
+        self.forward = None
+
+    def publish(self, jpeg: bytes):
+        with self.cond:
+            # Same bytes object means nothing changed
+            if jpeg is self.frame:
+                return
+            self.frame = jpeg
+            self.version += 1
+            self.cond.notify_all()
+
+        # Drop the frame rather than wait on a slow parent
+        if self.forward is not None:
+            try:
+                self.forward.put_nowait(jpeg)
+            except queue.Full:
+                pass
+
+    def frames(self):
+        """ Yields each new frame once, starting with the current one. """
+        seen = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.version != seen)
+                frame, seen = self.frame, self.version
+            yield frame
+
+frames = FrameHub()
+
+def publish_frame(jpeg: bytes):
+    """ Hand the current frame's JPEG bytes to anyone watching. """
+    frames.publish(jpeg)
+
+def forward_frames(frame_queue):
+    """ Worker side: also send published frames to the parent over frame_queue. """
+    frames.forward = frame_queue
+
+def receive_frames(frame_queue):
+    """ Parent side: publish every frame a worker forwards, so the live view works with subprocess envs. """
+    def pump():
+        while True:
+            frames.publish(frame_queue.get())
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+@app.route('/stream')
+def stream():
+    """ MJPEG stream, pushes a part only when the frame changes. """
+    def parts():
+        for frame in frames.frames():
+            yield (b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(frame)).encode()
+                   + b"\r\n\r\n" + frame + b"\r\n")
+    return Response(parts(), mimetype="multipart/x-mixed-replace; boundary=frame")
+
 def start_server(port=5000):
     """
     Starts the Flask app in a thread so it doesn't block.
     """
-    import threading
-
     def run_app():
-        app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+        app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False, threaded=True)
 
     thread = threading.Thread(target=run_app, daemon=True)
     thread.start()
@@ -16,6 +16,8 @@ class Stop:
     viewpoints: list
     false_negative: bool
     heading: float
+    stop_id: str = None
+    members: list = None        # Nearby stops that share this one's episode
 
     def calc_cords(self):
         # Get two highest scoring viewpoints (or some other criteria)
@@ -1,52 +1,151 @@
 from settings import S
 from ultralytics import YOLO
+from dataclasses import dataclass
+from resources.profiling import timings
+from resources.preprocess import FramePreprocessor
 import torch
 import cv2
 import numpy as np
 
+@dataclass
+class Detection:
+    """ Everything the env needs from one YOLO pass over a frame. """
+    feats: np.ndarray                   # Pooled backbone features + kept boxes (extract_features)
+    feats_found: bool                   # Stop among the kept boxes
+    conf: float                         # Score from score_output
+    found: bool                         # Stop among all boxes
+    boxes: dict                         # Label -> conf
+    box_sz: float                       # Biggest stop box (normalized area)
+    output: object = None               # Raw Results, only when the model actually ran
+    box_table: np.ndarray = None        # Top S.screenshot_boxes boxes as [x1, y1, x2, y2, conf, cls] (normalized)
+
 # A wrapper for the YOLO model trained to detect stops
 class StopDetector:
 
-    def __init__(self):
-        self.model = YOLO(S.yolo_path)
+    def __init__(self, model: YOLO = None):
         self.frame_num = 0
+        self._tapped = None
+
+        # Exported graph (ONNX / TorchScript) gives boxes and features in one call
+        if S.detector_backend != "ultralytics":
+            # Exports only produce the tapped features, feeding them to a legacy-trained policy would be silently wrong
+            if S.feature_source == "legacy":
+                raise ValueError(f"detector_backend={S.detector_backend!r} only supports feature_source='tapped', "
+                                 "use the ultralytics backend for policies trained on legacy features")
+            from resources.exported_detector import ExportedDetector
+            self.model = None
+            self.exported = ExportedDetector()
+            self.names = self.exported.names
+
+        # Weights can be handed in so forked workers share one copy
+        else:
+            self.model = model or YOLO(S.yolo_path)
+            self.exported = None
+            self.names = self.model.names
+
+            # Frames are letterboxed into one reusable buffer
+            self.pre = FramePreprocessor(S.detector_batch)
+
+            # Tap the backbone (layer 10) so features come out of the same forward pass as the boxes
+            self.model.model.model[10].register_forward_hook(self._tap)
+
+        # Class lookups for the vectorized box code
+        self.labels = np.array([self.names[i] for i in range(len(self.names))], dtype=object)
+        self.primary = np.array([label in {"shelter", "sign"} for label in self.labels])
+
+    def _tap(self, module, inputs, output):
+        """ Forward hook, keeps the layer-10 feature map of the last pass. """
+        self._tapped = output
 
     def run(self, img):
-        # Alert console 
-        print("\n[Stop Detector] Running model...")
+        return self.run_batch([img])[0]
 
-        # Run model
-        output = self.model(img)[0]
-        return output
+    def run_batch(self, imgs):
+        """ One forward pass per S.detector_batch frames, Results (with pooled_feats) per frame. """
+        # Alert console 
+        if S.request_msgs: print("\n[Stop Detector] Running model...")
+
+        # Exported graph does its own preprocessing and pooling
+        if self.exported:
+            return [self.exported(img) for img in imgs]
+
+        outputs = []
+        for start in range(0, len(imgs), S.detector_batch):
+            # Frames go in as a ready-made tensor, so the predictor skips its own preprocessing
+            batch = self.pre.load_batch(imgs[start:start + S.detector_batch])
+
+            # Run model, hook grabs backbone features along the way
+            with torch.no_grad():
+                results = self.model(batch, conf=S.detector_conf, iou=S.detector_iou, verbose=False)
+
+                # Global average pooling (512-dim output), attached to the results it came from
+                if S.feature_source == "legacy":
+                    pooled = self.legacy_features(imgs[start:start + S.detector_batch])
+                else:
+                    pooled = self._tapped.mean(dim=[2, 3]).cpu().numpy()
+            for output, feats in zip(results, pooled):
+                output.pooled_feats = feats
+                outputs.append(output)
+            self._tapped = None
+        return outputs
+
+    def legacy_features(self, imgs):
+        """
+        Pooled layer-10 features the way checkpoints trained before the tapped path saw them:
+        a second backbone pass over the BGR frame, plainly resized to S.img_size (no letterbox).
+        """
+        x = np.stack([cv2.resize(img, S.img_size) for img in imgs]).astype(np.float32) / 255.0
+        x = torch.from_numpy(x.transpose(0, 3, 1, 2)).to(next(self.model.model.parameters()).device)
+        with torch.no_grad():
+            features = self.model.model.model[:11](x)
+        return features.mean(dim=[2, 3]).cpu().numpy()
+
+    def detect(self, img):
+        """ Run the model once and gather both the features and the score. """
+        with timings.span("detector"):
+            output = self.run(img)
+        with timings.span("extract_features"):
+            feats, feats_found = self.extract_features(output)
+        with timings.span("score_output"):
+            conf, found, boxes, box_sz = self.score_output(output)
+        return Detection(feats, feats_found, conf, found, boxes, box_sz, output,
+                         box_table=self.box_table(output)[:S.screenshot_boxes])
+
+    def box_table(self, output):
+        """
+        All boxes as one (n, 6) array of [x1, y1, x2, y2, conf, cls] (normalized coords),
+        pulled to the host in a single transfer and kept on the output for reuse.
+        """
+        table = getattr(output, "box_table", None)
+        if table is None:
+            boxes = output.boxes
+            if boxes is None or len(boxes) == 0:
+                table = np.zeros((0, 6), dtype=np.float32)
+            else:
+                table = torch.cat([boxes.xyxyn, boxes.conf[:, None], boxes.cls[:, None]], dim=1).cpu().numpy()
+            output.box_table = table
+        return table
 
     def score_output(self, output):
         # No boxes
-        if len(output.boxes) == 0: 
+        table = self.box_table(output)
+        if len(table) == 0: 
             return 0.0, False, None, 0
 
-        # Scores to be calculated
-        primary_score = 0.0
-        secondary_score = 0.0
-        found = False
-        
-        # Remake boxes to preserve memory, calc score
-        boxes = {}
-        biggest_box = 0
-        for box in output.boxes:
-            label = self.model.names[int(box.cls)]
-            conf = float(box.conf)
-            boxes[label] = conf
-            # Take best evidence of a sign/shelter
-            if label in {"shelter", "sign"}:
-                primary_score = max(primary_score, conf)
-                found = True
-
-                # Determine if this is the "biggest" evidence of a stop
-                box_size = float(box.xywhn[0][2] * box.xywhn[0][3])
-                if box_size > biggest_box:
-                    biggest_box = box_size
-            else:
-                secondary_score += conf
+        # Split boxes into primary (sign/shelter) and secondary amenities
+        x1, y1, x2, y2, confs = table[:, 0], table[:, 1], table[:, 2], table[:, 3], table[:, 4]
+        classes = table[:, 5].astype(np.int64)
+        primary = self.primary[classes]
+        found = bool(primary.any())
+
+        # Take best evidence of a sign/shelter, and the "biggest" evidence of a stop
+        primary_score = float(confs[primary].max(initial=0.0))
+        areas = (x2 - x1) * (y2 - y1)
+        biggest_box = float(areas[primary].max(initial=0.0))
+        secondary_score = float(confs[~primary].sum())
+
+        # Remake boxes to preserve memory (later boxes overwrite earlier ones of the same label)
+        boxes = dict(zip(self.labels[classes].tolist(), confs.tolist()))
 
         # Normalize secondary score if needed
         secondary_score = min(secondary_score, 1.0 - primary_score)
@@ -55,62 +154,30 @@ class StopDetector:
         total_score = primary_score + S.secondary_boost * secondary_score
         return min(total_score, 1.0), found, boxes, biggest_box
     
-    def extract_features(self, img, output):
-        # Resize and normalize image
-        img_resized = cv2.resize(img, S.img_size)
-        img_resized = img_resized.astype(np.float32) / 255.0
-        img_tensor = torch.tensor(np.transpose(img_resized, (2, 0, 1)), dtype=torch.float32).unsqueeze(0).to(self.model.device)
-
-        # Ensure weigghts are frozen
-        with torch.no_grad():
-            # Extract backbone, run image through it to get features
-            features = self.model.model.model[:11](img_tensor) 
-
-            # Global average pooling (512-dim output)
-            pooled_feats = features.mean(dim=[2, 3]).squeeze().cpu().numpy()
-
-            # Get detections
-            boxes = output.boxes
-            det_vecs = []
-            found = False
-
-            # Go through as many bounding boxes as are to be kept
-            if boxes is not None and len(boxes) > 0:
-                for i, box in enumerate(boxes):
-                    if i >= S.bbs_kept:
-                        break
-                    
-                    # Check if found :(
-                    if self.model.names[int(box.cls)] in {"shelter", "sign"}:
-                        found = True
-
-                    # Bounding box info
-                    x1, y1, x2, y2 = box.xyxyn[0].cpu().numpy()
-                    x_cord = (x1 + x2) / 2
-                    y_cord = (y1 + y2) / 2
-                    area = (x2 - x1) * (y2 - y1)
-                    conf = float(box.conf)
-                    cls = int(box.cls)
-
-                    # One-hot class encoding
-                    class_one_hot = np.zeros(S.num_classes)
-                    if 0 <= cls < S.num_classes:
-                        class_one_hot[cls] = 1.0
-
-                    # Final vector per box: [xc, yc, area, conf] + one-hot class
-                    det_vec = np.concatenate([[x_cord, y_cord, area, conf], class_one_hot])
-                    det_vecs.append(det_vec)
-
-                det_vecs = np.vstack(det_vecs)
-            else:
-                # No detections: fill with zeros
-                det_vecs = np.zeros((S.bbs_kept, 4 + S.num_classes))
-
-            # Pad if fewer than bbs_kept
-            if det_vecs.shape[0] < S.bbs_kept:
-                padding = np.zeros((S.bbs_kept - det_vecs.shape[0], 4 + S.num_classes))
-                det_vecs = np.vstack([det_vecs, padding])
-
-            # Flatten vector
-            box_flat = det_vecs.flatten()
-            return np.concatenate([pooled_feats, box_flat]), found
\ No newline at end of file
+    def extract_features(self, output):
+        # One output vector: [pooled feats | bbs_kept x ([xc, yc, area, conf] + one-hot class)], zero padded
+        feats = np.zeros(S.features_dim + S.bbs_kept * (4 + S.num_classes), dtype=np.float32)
+
+        # Backbone features were pooled during run(), no second pass needed
+        feats[:S.features_dim] = output.pooled_feats
+
+        # Go through as many bounding boxes as are to be kept
+        table = self.box_table(output)[:S.bbs_kept]
+        kept = len(table)
+        box_vecs = feats[S.features_dim:].reshape(S.bbs_kept, 4 + S.num_classes)
+
+        # Bounding box info
+        x1, y1, x2, y2, confs = table[:, 0], table[:, 1], table[:, 2], table[:, 3], table[:, 4]
+        box_vecs[:kept, 0] = (x1 + x2) / 2
+        box_vecs[:kept, 1] = (y1 + y2) / 2
+        box_vecs[:kept, 2] = (x2 - x1) * (y2 - y1)
+        box_vecs[:kept, 3] = confs
+
+        # One-hot class encoding
+        classes = table[:, 5].astype(np.int64)
+        valid = (classes >= 0) & (classes < S.num_classes)
+        box_vecs[np.arange(kept)[valid], 4 + classes[valid]] = 1.0
+
+        # Check if found :(
+        found = bool(self.primary[classes].any())
+        return feats, found
@@ -1,32 +1,84 @@
 from dataclasses import dataclass
-import requests 
 from resources.stop import Stop
-from requests.exceptions import RequestException
+from resources.cache import ImageCache, MetaCache, StreetDirCache, quantize_heading
+from resources.http_client import HttpClient
+from resources.prefetch import Prefetcher
+from resources.server import publish_frame
+from resources.counters import api_calls
+from resources.profiling import timings
 # from playwright.sync_api import sync_playwright
 import json
 from settings import S
 import numpy as np
 import math
-from pathlib import Path
-from requests.exceptions import ReadTimeout
-import time
 import cv2
 import re
+from copy import copy
+import threading
+from concurrent.futures import Future
+from collections import OrderedDict
+
+# Optional libjpeg-turbo bindings
+try:
+    from turbojpeg import TurboJPEG
+    _turbo = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    _turbo = None
+
+# Size frames are requested at (width, height)
+FRAME_DIMS = [640, 640]
+
+def decode_scale(height, width):
+    """ Largest of 1, 2, 4, 8 that a frame can be shrunk by while still covering S.img_size. """
+    if not S.reduced_decode:
+        return 1
+    scale = 1
+    while scale < 8 and width // (scale * 2) >= S.img_size[0] and height // (scale * 2) >= S.img_size[1]:
+        scale *= 2
+    return scale
+
+def decode_jpeg(content: bytes):
+    """ JPEG bytes to a BGR image, at reduced scale if the detector doesn't need all of it. """
+    if S.jpeg_decoder == "turbojpeg" and _turbo:
+        height, width, _, _ = _turbo.decode_header(content)
+        scale = decode_scale(height, width)
+        return _turbo.decode(content, scaling_factor=(1, scale) if scale > 1 else None)
+
+    # cv2 can only be told the scale, so go off the size we ask Street View for
+    reduced = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+               4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    return cv2.imdecode(np.frombuffer(content, np.uint8), reduced[decode_scale(*FRAME_DIMS[::-1])])
 
 class StreetView:
     def __init__(self):
         self.key: str
         self.reqs: Requests
+        self.prefetcher: Prefetcher = None
         self.current_img = None
+        self._decoded = OrderedDict()
         self.start_stop: Stop
         self.current_stop: Stop
         self.current_pic: Pic
 
     def launch(self, key_path = "key.txt"):
         """ Read key and build requests class (handles interfacing with API)"""
+        from resources.replay import RecordingRequests, ReplayRequests
+
+        # Replays come entirely from the archive, no key or network needed
+        if S.backend == "replay":
+            self.reqs = ReplayRequests(S.archive_path, FRAME_DIMS)
+            return
+
         # Read key, start requests
         key = open(key_path, "r").read()
-        self.reqs = Requests(key, [640,640])
+        if S.backend == "record":
+            self.reqs = RecordingRequests(S.archive_path, key, FRAME_DIMS)
+        else:
+            self.reqs = Requests(key, FRAME_DIMS)
+
+        # Speculatively pull the next views in the background (needs the caches to land in)
+        if S.prefetch and S.use_cache:
+            self.prefetcher = Prefetcher(self)
 
         # # Launch playwright browser
         # browser = sync_playwright().start().chromium.launch(headless=True)
@@ -51,27 +103,41 @@ class StreetView:
                 lng=stop.og_lng,
             )
         
-        # Go to the starting pic (space bar was pressed)
+        # Go to the starting pic (space bar was pressed), keeping the start itself untouched
         else:
-            self.current_pic = self.start_pic
+            self.current_pic = copy(self.start_pic)
 
         # Pull metadata request to find pano location
         self.reqs.pull_pano_info(self.current_pic)
-        self._estimate_heading(self.current_pic, stop)
+        if stop:
+            self._estimate_heading(self.current_pic, stop)
 
         # Pull image
-        self.current_img = self.reqs.pull_image(self.current_pic)
+        with timings.span("image"):
+            self.current_img = self.reqs.pull_image(self.current_pic)
+        self._prefetch()
         return True
 
     def get_img(self):
-        """ Load bytes from streetview into CV2 image. """
-        # Decode bytes into image, return it
-        nparr = np.frombuffer(self.current_img, np.uint8)
-        try:
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        except Exception as e:
-            print(f"Error decoding image: {e}")
-        cv2.imwrite("resources/static/frame.jpg", img)
+        """ Load bytes from streetview into CV2 image (decoded once per frame, treat it as read-only). """
+        # Same bytes, same image
+        content = self.current_img
+        img = self._decoded.get(content)
+        if img is not None:
+            self._decoded.move_to_end(content)
+        else:
+            try:
+                with timings.span("decode"):
+                    img = decode_jpeg(content)
+                img.flags.writeable = False
+                self._decoded[content] = img
+                if len(self._decoded) > S.decode_cache_size:
+                    self._decoded.popitem(last=False)
+            except Exception as e:
+                print(f"Error decoding image: {e}")
+
+        # Push the raw JPEG to the live view, no re-encode or disk write
+        publish_frame(content)
         return img
 
     def do_action(self, action):
@@ -97,10 +163,17 @@ class StreetView:
             self._zoom()
 
         # Pull new pic
-        if self.current_pic.zoom_lvl > 0:
-            self.current_img = self.reqs.old_pull_img(self.current_pic)
-        else:
-            self.current_img = self.reqs.pull_image(self.current_pic)
+        with timings.span("image"):
+            if self.current_pic.zoom_lvl > 0:
+                self.current_img = self.reqs.old_pull_img(self.current_pic)
+            else:
+                self.current_img = self.reqs.pull_image(self.current_pic)
+        self._prefetch()
+
+    def _prefetch(self):
+        """ Queue up the views reachable from here while the detector/policy run. """
+        if self.prefetcher:
+            self.prefetcher.schedule(self.current_pic)
     
     def goto_start(self):
         """ Go back to the initial position. """
@@ -109,16 +182,20 @@ class StreetView:
     def set_start(self):
         """ Basically tells class to reset. """
         # Logs the current pic (location, heading) as starting point
-        self.start_pic = self.current_pic
+        self.start_pic = copy(self.current_pic)
+
+    def _offset(self, pic, heading, dist = 8):
+        """ Pic `dist` meters away from `pic` along `heading`, still facing pic's heading. """
+        # Calculate new coordinates
+        earth_radius = 6378137
+        heading_rad = math.radians(heading)
+        new_lat = pic.lat + (dist / earth_radius) * math.cos(heading_rad) * (180 / math.pi)
+        new_lng = pic.lng + (dist / earth_radius) * math.sin(heading_rad) * (180 / math.pi) / math.cos(math.radians(pic.lat))
+        return Pic(pic.heading, new_lat, new_lng)
 
     def _move(self, direction = 'w', dist = 8, heading = None):
         def _calc_coords(heading):
-            # Calculate new coordinates
-            earth_radius = 6378137
-            heading_rad = math.radians(heading)
-            new_lat = self.current_pic.lat + (dist / earth_radius) * math.cos(heading_rad) * (180 / math.pi)
-            new_lng = self.current_pic.lng + (dist / earth_radius) * math.sin(heading_rad) * (180 / math.pi) / math.cos(math.radians(self.current_pic.lat))
-            return Pic(self.current_pic.heading, new_lat, new_lng)
+            return self._offset(self.current_pic, heading, dist)
         
         # Reset zoom level 
         self.current_pic.zoom_lvl = 0
@@ -171,65 +248,14 @@ class StreetView:
         self.current_pic = pic
 
     def _get_street_dir(self):
-            # Build request URL
-            url = ("https://maps.googleapis.com/maps/api/js/GeoPhotoService.SingleImageSearch"
-                    "?pb=!1m5!1sapiv3!5sUS!11m2!1m1!1b0!2m4!1m2!3d{lat}!4d{lon}!2d50!3m10"
-                    "!2m2!1sen!2sGB!9m1!1e2!11m4!1m3!1e2!2b1!3e2!4m10!1e1!1e2!1e3!1e4!1e8!1e6!5m1!1e2!6m1!1e2"
-                    "&callback=callbackfunc"
-                ).format(lat=self.current_pic.lat, lon=self.current_pic.lng)
-            
-            # Build request header
-            headers = {
-                    "User-Agent": "Mozilla/5.0",
-                    "Accept": "*/*",
-                    "Referer": "https://maps.google.com/",
-                }
-            
-            # Send request
-            try:
-                r = requests.get(url, headers=headers, timeout=10)
-            except Exception as e:
-                return None
-
-            # Strip JSON from payload text
-            m = re.search(rf"{re.escape("callbackfunc")}\s*\(\s*(.*)\s*\)\s*;?\s*$", r.text, re.DOTALL)
-            if not m:
-                return None
-            data = json.loads(m.group(1))
-
-            # Check if we found anything
-            if data == [[5, "generic", "Search returned no images."]]:
-                return None
-
-            # Pull out heading
-            subset = data[1][5][0]
-            raw_panos = subset[3][0]
-            raw_panos = raw_panos[::-1]
-            heading = float(raw_panos[0][2][2][0])
-            return heading
+        """ Bearing of the street at the current location, None if there isn't one. """
+        return self.reqs.pull_street_dir(self.current_pic.lat, self.current_pic.lng)
     
     def _api_move(self, direction='w'):
         pano_id_result = {}
         
         # Write to API counter
-        path = Path(f"{S.log_dir}/api_calls.txt")
-        path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # If file exists, read and increment
-        if path.exists():
-            with open(path, "r+") as f:
-                try:
-                    count = int(f.read())
-                except ValueError:
-                    count = 0
-                count += 1
-                f.seek(0)
-                f.write(str(count))
-                f.truncate()
-        else:
-            # Create file and initialize to 1
-            with open(path, "w") as f:
-                f.write("1")
+        api_calls.count("pano_links")
                 
         def handle_console(msg):
             try:
@@ -318,45 +344,67 @@ class Pic:
     def get_coords(self):
         return f"{self.lat},{self.lng}"
 
+# JSONP wrapper around GeoPhotoService responses
+CALLBACK_RE = re.compile(r"callbackfunc\s*\(\s*(.*)\s*\)\s*;?\s*$", re.DOTALL)
+
+def image_endpoint(pic: Pic):
+    """ Zoomed images are counted apart from regular ones. """
+    return "zoomed_image" if pic.zoom_lvl > 0 else "image"
+
 class Requests:
-    def __init__(self, key: str, pic_dims, debug = False):
+    def __init__(self, key: str, pic_dims, debug = False, use_cache = S.use_cache):
         self.key = key
         self.debug = debug
         if pic_dims:
             self.pic_len = pic_dims[0]
             self.pic_height = pic_dims[1]
 
-    def old_pull_img(self, pic: Pic):
-        if S.request_msgs: print("Pulling image")
-        path = Path(f"{S.log_dir}/api_calls.txt")
-        path.parent.mkdir(parents=True, exist_ok=True)
-        
-        # If file exists, read and increment
-        if path.exists():
-            with open(path, "r+") as f:
-                try:
-                    count = int(f.read())
-                except ValueError:
-                    count = 0
-                count += 1
-                f.seek(0)
-                f.write(str(count))
-                f.truncate()
-        else:
-            # Create file and initialize to 1
-            with open(path, "w") as f:
-                f.write("1")
+        # Keep-alive connections, rate limited
+        self.client = HttpClient()
+
+        # Requests currently on the wire, so the prefetcher and the env never pull the same thing twice
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # Images, metadata and street bearings already pulled (shared across runs and processes)
+        self.image_cache = ImageCache() if use_cache else None
+        self.meta_cache = MetaCache() if use_cache else None
+        self.street_cache = StreetDirCache() if use_cache else None
+
+    def pull_image(self, pic: Pic):
+        """ Pull the image for a pic, zoom level decides the FOV. """
+        return self.old_pull_img(pic)
 
+    def image_key(self, pic: Pic):
+        """ FOV, size string and cache key for a pic's image. """
         # Add zoom level (FOV)
         zoom_to_fov = {0: 90, 1: 60, 2: 30}
         fov = zoom_to_fov[pic.zoom_lvl]
+        size = f"{self.pic_len}x{self.pic_height}"
+        return fov, size, ImageCache.key(pic, fov, size)
+
+    def old_pull_img(self, pic: Pic):
+        # Serve from cache if we've seen this view before
+        fov, size, cache_key = self.image_key(pic)
+        if self.image_cache:
+            content = self.image_cache.get(cache_key)
+            if content:
+                api_calls.hit(image_endpoint(pic))
+                return content
+
+        # Wait on the prefetcher instead of asking twice
+        return self._single_flight(f"img|{cache_key}", lambda: self._fetch_image(pic, fov, size, cache_key))
+
+    def _fetch_image(self, pic: Pic, fov, size, cache_key):
+        if S.request_msgs: print("Pulling image")
+        api_calls.count(image_endpoint(pic))
 
         # Parameters for API request
         pic_params = {
             'key': self.key,
             'return_error_code': True,
             'outdoor': True,
-            'size': f"{self.pic_len}x{self.pic_height}",
+            'size': size,
             'fov':fov}
 
         # Add either pano ID or location
@@ -365,9 +413,9 @@ class Requests:
         else:
             pic_params['location'] = pic.get_coords()
 
-        # Add heading if there is any
+        # Add heading if there is any (snapped so it matches what gets cached)
         if pic.heading:
-            pic_params['heading'] = pic.heading
+            pic_params['heading'] = quantize_heading(pic.heading)
 
         # Pull response 
         response = self._pull_response(
@@ -379,6 +427,8 @@ class Requests:
         # Close response, return content 
         content = response.content
         response.close()
+        if self.image_cache:
+            self.image_cache.put(cache_key, content)
         if S.request_msgs: print("[Requests] Done pulling image.")
         return content
 
@@ -386,9 +436,36 @@ class Requests:
         """
         Extract coordiantes from a pano's metadata, used to determine heading
         """
+        # Handle finding no results
+        with timings.span("metadata"):
+            meta = self._metadata(pic)
+        if meta is None:
+            return False
+
+        # Fetch the coordinates from the json response and store them in the POI
+        pano_location = meta.get("location")
+        pic.lng = pano_location["lng"]
+        pic.lat = pano_location["lat"]
+        pic.pano_id = meta.get("pano_id")
+        pic.date = meta.get("date")
+        return True
+
+    def _metadata(self, pic: Pic):
+        """ Metadata JSON for a pic (by pano ID or location), None if there's no pano. """
+        # Known panos and known dead spots don't need a request
+        if self.meta_cache:
+            meta = self.meta_cache.lookup(pic)
+            if meta is not MetaCache.MISS:
+                api_calls.hit("metadata")
+                return meta
 
+        # Wait on the prefetcher instead of asking twice
+        where = pic.pano_id or MetaCache.cell(pic.lat, pic.lng)
+        return self._single_flight(f"meta|{where}", lambda: self._fetch_metadata(pic))
+
+    def _fetch_metadata(self, pic: Pic):
         if S.request_msgs: print("[Requests] Pulling metadata")
-        time.sleep(.2)
+        api_calls.count("metadata")
         # Params for request
         params = {
             'key': self.key,
@@ -407,39 +484,108 @@ class Requests:
             context="Pulling metadata",
             base='https://maps.googleapis.com/maps/api/streetview/metadata?')
         
-        # Handle finding no results
-        if b'ZERO_RESULTS' in response.content:
-            return False
-        
-        # Fetch the coordinates from the json response and store them in the POI
-        pano_location = response.json().get("location")
-        pic.lng = pano_location["lng"]
-        pic.lat = pano_location["lat"]
-        pic.pano_id = response.json().get("pano_id")
-        pic.date = response.json().get("date")
+        # No pano here
+        meta = None
+        if b'ZERO_RESULTS' not in response.content:
+            meta = response.json()
         response.close()
+
+        # Anything other than OK / ZERO_RESULTS (quota, bad key...) is treated as no pano but not remembered
+        if meta and meta.get("status", "OK") != "OK":
+            return None
+        if self.meta_cache:
+            self.meta_cache.put(pic, meta)
         if S.request_msgs: print("[Requests] Done pulling metadata.")
-        return True
+        return meta
+
+    def pull_street_dir(self, lat, lng):
+        """ Heading of the street nearest to a point, None if there isn't one. """
+        # Bearings don't change, so nearby lookups are answered from disk
+        if self.street_cache:
+            heading = self.street_cache.lookup(lat, lng)
+            if heading is not StreetDirCache.MISS:
+                api_calls.hit("street_dir")
+                return heading
+
+        cell = StreetDirCache.cell(lat, lng)
+        return self._single_flight(f"street|{cell}", lambda: self._fetch_street_dir(lat, lng))
+
+    def _fetch_street_dir(self, lat, lng):
+        """ Ask GeoPhotoService for the heading of the street nearest to a point. """
+        # Build request URL
+        url = ("https://maps.googleapis.com/maps/api/js/GeoPhotoService.SingleImageSearch"
+                "?pb=!1m5!1sapiv3!5sUS!11m2!1m1!1b0!2m4!1m2!3d{lat}!4d{lon}!2d50!3m10"
+                "!2m2!1sen!2sGB!9m1!1e2!11m4!1m3!1e2!2b1!3e2!4m10!1e1!1e2!1e3!1e4!1e8!1e6!5m1!1e2!6m1!1e2"
+                "&callback=callbackfunc"
+            ).format(lat=lat, lon=lng)
+        
+        # Build request header
+        headers = {
+                "User-Agent": "Mozilla/5.0",
+                "Accept": "*/*",
+                "Referer": "https://maps.google.com/",
+            }
+        
+        # Send request
+        api_calls.count("street_dir")
+        try:
+            r = self.client.get(url, headers=headers)
+        except Exception as e:
+            return None
+
+        # Strip JSON from payload text
+        m = CALLBACK_RE.search(r.text)
+        if not m:
+            return None
+        data = json.loads(m.group(1))
+
+        # Check if we found anything (worth remembering too)
+        if data == [[5, "generic", "Search returned no images."]]:
+            heading = None
+        else:
+            # Pull out heading
+            subset = data[1][5][0]
+            raw_panos = subset[3][0]
+            raw_panos = raw_panos[::-1]
+            heading = float(raw_panos[0][2][2][0])
+
+        # Failed requests above aren't cached, only real answers
+        if self.street_cache:
+            self.street_cache.put(lat, lng, heading)
+        return heading
+
+    def _single_flight(self, key, fetch):
+        """ Run fetch() unless another thread is already fetching the same key, then share its result. """
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            result = fetch()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
 
     def _pull_response(self, params, context, base, coords):
         # Print a sumamry of the request if debugging 
         if self.debug: print(f"[REQUEST] {context} for {coords}")
         
-        # Retry several times
-        for i in range(10):
-            try:
-                response = requests.get(base, params=params, timeout=10)
-                response.raise_for_status()
-                return response
-            except ReadTimeout:
-                print(f"[Retry {i+1}] Waiting 5 seconds")
-                time.sleep(5)
+        # Pooled client handles throttling and retries
+        response = self.client.get(base, params=params)
+        response.raise_for_status()
 
         # Check for empty response 
         if not response.content:
-            return Error(context, "empty response")
-        
-        # Return error if the request was not successful
-        else:
             response.close()
-            return Error(context, f"({response.status_code}): {response.text}")
\ No newline at end of file
+            return Error(context, "empty response")
+        return response
\ No newline at end of file
@@ -0,0 +1,105 @@
+"""
+Per-step trajectories as compressed, columnar .npz chunks, for analysis and offline training
+without repeating API calls or YOLO passes.
+
+Each chunk holds S.trajectory_chunk steps (fewer in the last one) with the columns:
+    stop_id, pano_id            str
+    episode, step               int32 (step 0 is the reset, action -1)
+    heading                     float32
+    zoom, action                int8
+    reward, conf                float32
+    found, done                 bool
+    class_confs                 float32 (n, num classes), NaN where a class wasn't seen
+    obs                         float32 (n, S.frame_dim), what the policy saw
+"""
+import os
+from glob import glob
+import numpy as np
+from resources.writer import BackgroundWriter
+from settings import S
+
+class TrajectoryRecorder:
+    """ Fills fixed-size column buffers and hands full chunks to a background writer. """
+
+    def __init__(self, names: dict, writer: BackgroundWriter, root=None, chunk_steps=S.trajectory_chunk):
+        self.root = root or f"{S.log_dir}trajectories"
+        os.makedirs(self.root, exist_ok=True)
+        self.label_idx = {label: i for i, label in names.items()}
+        self.writer = writer
+        self.chunk_steps = chunk_steps
+        self.chunks = 0
+        self.episodes = -1
+        self.n = 0
+
+        # Preallocated once, reused for every chunk
+        self.columns = {
+            "stop_id": np.empty(chunk_steps, dtype=object),
+            "pano_id": np.empty(chunk_steps, dtype=object),
+            "episode": np.zeros(chunk_steps, dtype=np.int32),
+            "step": np.zeros(chunk_steps, dtype=np.int32),
+            "heading": np.zeros(chunk_steps, dtype=np.float32),
+            "zoom": np.zeros(chunk_steps, dtype=np.int8),
+            "action": np.zeros(chunk_steps, dtype=np.int8),
+            "reward": np.zeros(chunk_steps, dtype=np.float32),
+            "conf": np.zeros(chunk_steps, dtype=np.float32),
+            "found": np.zeros(chunk_steps, dtype=bool),
+            "done": np.zeros(chunk_steps, dtype=bool),
+            "class_confs": np.zeros((chunk_steps, len(names)), dtype=np.float32),
+            "obs": np.zeros((chunk_steps, S.frame_dim), dtype=np.float32),
+        }
+
+    def start_episode(self):
+        self.episodes += 1
+
+    def add(self, episode, pic, detection, obs, action=-1, reward=0.0, done=False):
+        """ Record one step (action -1 for the reset observation). """
+        i, cols = self.n, self.columns
+        cols["stop_id"][i] = episode.stop.stop_id
+        cols["pano_id"][i] = pic.pano_id
+        cols["episode"][i] = self.episodes
+        cols["step"][i] = episode.steps
+        cols["heading"][i] = pic.heading
+        cols["zoom"][i] = pic.zoom_lvl
+        cols["action"][i] = action
+        cols["reward"][i] = reward
+        cols["conf"][i] = detection.conf
+        cols["found"][i] = detection.found
+        cols["done"][i] = done
+
+        # Per-class confidences, NaN for classes not seen
+        cols["class_confs"][i] = np.nan
+        for label, conf in (detection.boxes or {}).items():
+            cols["class_confs"][i, self.label_idx[label]] = conf
+        cols["obs"][i] = obs
+
+        self.n += 1
+        if self.n == self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        """ Hand whatever is buffered to the writer as one chunk. """
+        if not self.n:
+            return
+
+        # The buffers get reused right away, so the writer gets its own copy
+        chunk = {name: col[:self.n].astype(str) if col.dtype == object else col[:self.n].copy()
+                 for name, col in self.columns.items()}
+        path = f"{self.root}/traj_{os.getpid()}_{self.chunks:06d}.npz"
+        self.writer.submit(write_chunk, path, chunk)
+        self.chunks += 1
+        self.n = 0
+
+def write_chunk(path, chunk):
+    # Written under a temp name so readers never see half a chunk
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **chunk)
+    os.replace(tmp, path)
+
+def load_trajectories(root=None):
+    """ Every chunk under root concatenated into one dict of columns. """
+    root = root or f"{S.log_dir}trajectories"
+    chunks = [dict(np.load(path)) for path in sorted(glob(f"{root}/traj_*.npz"))]
+    if not chunks:
+        return {}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
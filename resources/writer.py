@@ -0,0 +1,68 @@
+import queue
+import threading
+import cv2
+import numpy as np
+from settings import S
+
+class BackgroundWriter:
+    """
+    Runs disk writes on one daemon thread so the env step doesn't wait on them. The queue is
+    bounded: when the disk can't keep up, submit() blocks instead of piling work up in memory.
+    """
+
+    def __init__(self, max_pending=S.writer_max_pending, name="writer"):
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn, *args):
+        """ Queue fn(*args), blocking while the queue is full. Runs inline once closed. """
+        if self.closed:
+            fn(*args)
+            return
+        self.queue.put((fn, args))
+
+    def flush(self):
+        """ Wait until everything queued so far is written. """
+        self.queue.join()
+
+    def close(self):
+        """ Finish what's queued and stop the thread. Safe to call more than once. """
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception as e:
+                print(f"[{self.name}] Write failed: {e}")
+            finally:
+                self.queue.task_done()
+
+def save_screenshot(path, jpeg: bytes, box_table=None, names=None):
+    """ Write a frame's original JPEG, or draw its boxes (normalized [x1, y1, x2, y2, conf, cls] rows) on it first. """
+    if box_table is None:
+        with open(path, "wb") as f:
+            f.write(jpeg)
+        return
+
+    img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+    h, w = img.shape[:2]
+    for x1, y1, x2, y2, conf, cls in box_table:
+        # One colour per class
+        color = tuple(int(c) for c in np.random.default_rng(int(cls)).integers(64, 256, 3))
+        top_left, bottom_right = (int(x1 * w), int(y1 * h)), (int(x2 * w), int(y2 * h))
+        cv2.rectangle(img, top_left, bottom_right, color, 2)
+        label = f"{names[int(cls)] if names else int(cls)} {conf:.2f}"
+        cv2.putText(img, label, (top_left[0], max(top_left[1] - 5, 12)), cv2.FONT_HERSHEY_SIMPLEX, .5, color, 1, cv2.LINE_AA)
+    cv2.imwrite(path, img)
@@ -1,5 +1,9 @@
 from resources.streetview import StreetView
-from resources.stop_detector import StopDetector
+from resources.stop_detector import StopDetector, Detection
+from resources.feature_store import FeatureStore
+from resources.counters import api_calls
+from resources.profiling import timings, step_profile
+from time import perf_counter
 from resources.logging import LogManager
 from resources.misc import Misc
 from resources.loader import StopLoader
@@ -7,16 +11,20 @@ from settings import S
 import numpy as np
 import gymnasium as gym
 from atexit import register
-from cv2 import imwrite
+from resources.writer import BackgroundWriter, save_screenshot
+from resources.trajectory import TrajectoryRecorder
 
 class StreetViewEnv(gym.Env):
-    def __init__(self, streetview: StreetView, stop_loader: StopLoader):
+    def __init__(self, streetview: StreetView, stop_loader: StopLoader, yolo=None):
         # Set stuff up!!
         super().__init__()
         self.sv = streetview
-        self.stop_detector = StopDetector()
+        self.stop_detector = StopDetector(yolo)
         self.stop_loader = stop_loader
 
+        # Views we've already run YOLO on (shared across episodes, runs and workers)
+        self.feature_store = FeatureStore(self.stop_detector.names) if S.use_feature_store else None
+
         # PPO model design
         self.action_space = gym.spaces.Discrete(len(S.action_map))
         self.observation_space = gym.spaces.Box(
@@ -29,31 +37,78 @@ class StreetViewEnv(gym.Env):
         # Episode specific
         self.reset_next = True
         self.episode = None
+        self.exhausted = False
+
+        # Timing, the gap between steps is the policy's time
+        self.total_steps = 0
+        self.last_step_end = None
 
         # Setup logging, register for exit
         self.log_manager = LogManager(flush_every=2, flush_interval=10)
         register(self.log_manager.shutdown)
 
+        # Screenshots and trajectories are written off the step thread
+        self.writer = None
+        if S.save_screenshots or S.record_trajectories:
+            self.writer = BackgroundWriter(name="writer")
+            register(self.writer.close)
+        self.recorder = None
+        if S.record_trajectories:
+            self.recorder = TrajectoryRecorder(self.stop_detector.names, self.writer)
+            register(self.recorder.flush)
+
     def reset(self, seed=None, options=None):
+        # Out of stops (survey mode), idle until the caller notices
+        if self.stop_loader.exhausted():
+            self.exhausted = True
+            return np.zeros(self.observation_space.shape, dtype=self.observation_space.dtype), {"exhausted": True}
+
         # Get the next stop, load it 
         stop = self.stop_loader.load_stop()
 
         # Create new episode
-        self.episode = Episode(stop, self.stop_detector, self.log_manager, self.sv.current_pic)
+        self.episode = Episode(stop, self.stop_detector, self.log_manager, self.sv.current_pic,
+                               self.feature_store, self.writer)
         
         # Set up screenshot stack 
         img = self.sv.get_img()
-        yolo_output = self.stop_detector.run(img)
-        features = self.episode.get_features(img, yolo_output, self.sv.current_pic)
+        detection = self.episode.detect(img, self.sv.current_pic)
+        features = self.episode.get_features(detection, self.sv.current_pic)
+        if self.recorder:
+            self.recorder.start_episode()
+            self.recorder.add(self.episode, self.sv.current_pic, detection, features)
 
         # Reset episode-specific vars
         self.reset_next = False
 
+        # Don't count the reset as policy time
+        self.last_step_end = perf_counter()
+
         # Give model the observation
         features = np.array(features, dtype=self.observation_space.dtype)
         return features, {}
 
     def step(self, action):
+        # Whatever happened since the last step returned was the policy (plus vec env overhead)
+        if self.last_step_end:
+            timings.record("policy", perf_counter() - self.last_step_end)
+
+        self.total_steps += 1
+        with step_profile(self.total_steps), timings.span("step"):
+            result = self._step(action)
+        self.last_step_end = perf_counter()
+        return result
+
+    def stage_timings(self):
+        """ Raw stage timings since the last call, for TimingCallback. """
+        return timings.drain()
+
+    def _step(self, action):
+        # Nothing left to do
+        if self.exhausted:
+            obs = np.zeros(self.observation_space.shape, dtype=self.observation_space.dtype)
+            return obs, 0.0, True, False, {"exhausted": True}
+
         # Get key, take screenshot
         done = False
         key = S.action_map[action]
@@ -70,18 +125,36 @@ class StreetViewEnv(gym.Env):
         img = self.sv.get_img() 
 
         # Udate episode, let it score etc.
-        obs, reward, done = self.episode.update(key, img, self.sv.current_pic)
-        
-        return obs, reward, done, False, {"raw_reward": reward}
+        obs, reward, done = self.episode.update(key, img, self.sv.current_pic, self.sv.current_img)
+        if self.recorder:
+            self.recorder.add(self.episode, self.sv.current_pic, self.episode.last_detection, obs, action, reward, done)
+
+        # Hand finished stops back in the all_scores.json schema (used by survey mode)
+        info = {"raw_reward": reward}
+        if done:
+            info["stop_record"] = self.episode.score_record()
+        return obs, reward, done, False, info
+
+    def close(self):
+        # Subprocess workers exit without running atexit, so flush here too
+        self.log_manager.shutdown()
+        if self.recorder:
+            self.recorder.flush()
+        if self.writer:
+            self.writer.close()
+        api_calls.flush()
+        if self.sv.prefetcher:
+            self.sv.prefetcher.close()
 
 # Class for storing episode data
 class Episode():
-    def __init__(self, stop, stop_detector: StopDetector, log_manager: LogManager, pic):
+    def __init__(self, stop, stop_detector: StopDetector, log_manager: LogManager, pic,
+                 feature_store: FeatureStore = None, writer: BackgroundWriter = None):
         self.log = []
         self.reward = 0.0
         self.steps = 0
         self.found = False
-        self.best_img = (float(-999), None)
+        self.best_img = (float(-999), None, None)   # (reward, JPEG bytes, Detection)
         self.space_presses = 0
         self.amenity_scores = {}
         self.stop = stop
@@ -89,15 +162,33 @@ class Episode():
         self.found_viewpoints = []
         self.new_viewpoint = False
         self.stop_detector = stop_detector
+        self.feature_store = feature_store
         self.log_manager = log_manager
+        self.writer = writer
+        self.last_detection = None
         self.zoom_amt = 0
         
         # Determine geo info
         self.initial_lat, self.initial_lon, self.initial_heading = pic.lat, pic.lng, pic.heading
 
-    def get_features(self, img, output, pic):
+    def detect(self, img, pic) -> Detection:
+        """ Detector output for this view, from the feature store if it's been seen before. """
+        key = FeatureStore.key(pic)
+        if self.feature_store:
+            with timings.span("feature_store"):
+                detection = self.feature_store.get(key)
+            if detection:
+                return detection
+
+        # New view, run YOLO and remember it
+        detection = self.stop_detector.detect(img)
+        if self.feature_store:
+            self.feature_store.put(key, detection)
+        return detection
+
+    def get_features(self, detection: Detection, pic):
         # Get features, bb info from stop detector
-        yolo_feats, found = self.stop_detector.extract_features(img, output)
+        yolo_feats, found = detection.feats, detection.feats_found
 
         # Get spatial info from SV URL
         lat, lon, heading = pic.lat, pic.lng, pic.heading
@@ -154,7 +245,7 @@ class Episode():
         # Concat features
         return np.concat([yolo_feats, spatial_vec])
 
-    def update(self, key, img, pic):
+    def update(self, key, img, pic, jpeg=None):
         # Update steps
         self.steps += 1 
 
@@ -162,21 +253,22 @@ class Episode():
         if key == "Key.space":
             self.space_presses += 1
 
-        # Run stop detector model to get conf for assessment
-        output = self.stop_detector.run(img)
-        conf, found, boxes, box_sz = self.stop_detector.score_output(output)
+        # Run stop detector model (or look the view up) to get conf for assessment
+        detection = self.last_detection = self.detect(img, pic)
+        conf, found, boxes, box_sz = detection.conf, detection.found, detection.boxes, detection.box_sz
         
         # Extract features from observation
-        features = self.get_features(img, output, pic)
+        features = self.get_features(detection, pic)
 
         # See if this episode is finished
         done = False
-        if key == "Key.enter":
-            reward, done = self.check_done(found)
+        with timings.span("reward"):
+            if key == "Key.enter":
+                reward, done = self.check_done(found)
 
-        # Determine score if not
-        else:
-            reward, done = self.score(conf, key, found, box_sz)
+            # Determine score if not
+            else:
+                reward, done = self.score(conf, key, found, box_sz)
 
          # Update "found" status
         if found and not self.found:
@@ -194,7 +286,7 @@ class Episode():
 
         # Check if this is the best image (to save it later), add to reward
         if reward > self.best_img[0]:
-            self.best_img = (reward, img)
+            self.best_img = (reward, jpeg, detection)
         self.reward += reward 
 
         # Update box size
@@ -208,6 +300,17 @@ class Episode():
         Misc.announce(self, key, reward)
         return features, reward, done
     
+    def score_record(self):
+        """ [(stop ID, entry)] in the all_scores.json schema, for this stop and each stop grouped with it. """
+        return [(stop.stop_id, {
+            "latitude": self.initial_lat,
+            "longitude": self.initial_lon,
+            "latitude_og": stop.og_lat,
+            "longitude_og": stop.og_lng,
+            "gmaps_place_name": stop.place_name,
+            "amenity_scores": self.amenity_scores,
+        }) for stop in [self.stop, *(self.stop.members or [])]]
+
     def check_done(self, found):
         # Don't allow before bus stop has been found or attempts exhausted
         if not found and not self.found:
@@ -228,18 +331,12 @@ class Episode():
         if self.found and self.steps_since_found <= S.free_steps_after_found:
             reward += S.efficiency_bonus
 
-        # Write "best" image
-        if self.best_img and S.save_screenshots:
+        # Write "best" image in the background, annotated from the boxes we already have
+        if S.save_screenshots and self.writer and self.best_img[1] is not None:
             stop_name = self.stop.place_name.replace("/", "-")
-
-            # Run model again :( to get annotations on a copy of the best image
-            save_img = self.best_img[1].copy()
             filename=f"{S.log_dir}/{stop_name}_best.jpg"
-            if S.annotate_screenshots:
-                results = self.stop_detector.run(save_img)
-                results.save()
-            else:
-                imwrite(filename, save_img)
+            box_table = self.best_img[2].box_table if S.annotate_screenshots else None
+            self.writer.submit(save_screenshot, filename, self.best_img[1], box_table, self.stop_detector.names)
         
         # Tell model to finish this episode
         return reward, True
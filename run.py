@@ -2,29 +2,75 @@
 from stable_baselines3.common.callbacks import CheckpointCallback
 from stable_baselines3.common.logger import configure
 from stable_baselines3 import PPO
-from stable_baselines3.common.vec_env import DummyVecEnv, VecFrameStack
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv, VecFrameStack
+from ultralytics import YOLO
+from random import randint
+import multiprocessing as mp
+import json
+import os
+import time
+import torch
 
 # Project modules
 from resources.custom_policies import StopMLPPolicy
 from rl import StreetView, StreetViewEnv
 from settings import S 
 from resources.loader import StopLoader
-from resources.server import start_server
+from resources.catalog import Catalog
+from resources.server import start_server, forward_frames, receive_frames
+from resources.profiling import TimingCallback
+from resources.rollout_buffer import FrameStackRolloutBuffer
 
-def make_env(path: str):
-    # Create streetview and loader
+def make_env(path: str, rank=0, num_envs=1, seed=None, yolo=None, survey=False, skip_ids=None, frame_queue=None):
+    # Workers split the request budget and the CPU
+    if num_envs > 1:
+        S.requests_per_sec /= num_envs
+        torch.set_num_threads(S.torch_threads_per_env)
+
+    # The live view shows this worker's frames
+    if frame_queue is not None:
+        forward_frames(frame_queue)
+
+    # Create streetview and loader (surveys visit every stop as-is, once)
     sv = StreetView()
-    stop_loader = StopLoader(sv, True)
+    stop_loader = StopLoader(sv, not survey, survey)
 
-    # Load stops, launch SV
-    stop_loader.load_stops(path, shuffle_stops=True, num_positives=2000)
+    # Load this worker's share of the stops, launch SV
+    if survey:
+        stop_loader.load_stops(path, shuffle_stops=False, seed=seed, shard=(rank, num_envs), skip_ids=skip_ids,
+                               dedup=True)
+    else:
+        stop_loader.load_stops(path, shuffle_stops=True, num_positives=2000, seed=seed, shard=(rank, num_envs))
     sv.launch()
 
     # Pass YOLO to loader :(
-    env = StreetViewEnv(sv, stop_loader)
+    env = StreetViewEnv(sv, stop_loader, yolo)
     stop_loader.stop_detector = env.stop_detector
     return env
 
+def make_vec_env(path: str, num_envs=S.num_envs, survey=False, skip_ids=None):
+    """ One env per worker process, all sharing the same shuffled stop list and YOLO weights. """
+    # Load (and fuse, so workers don't rewrite the weights) once here; forked workers get them copy-on-write
+    yolo = None
+    if S.detector_backend == "ultralytics":
+        yolo = YOLO(S.yolo_path)
+        yolo.fuse()
+    seed = S.seed if S.seed is not None else randint(0, 2**31 - 1)
+
+    # Compile the catalog here so workers only have to map it
+    Catalog.open(path)
+    if num_envs == 1:
+        return DummyVecEnv([lambda: make_env(path, 0, 1, seed, yolo, survey, skip_ids)])
+
+    # The server lives in this process, so the first worker forwards its frames here
+    start_method = "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+    frame_queue = mp.get_context(start_method).Queue(maxsize=2)
+    receive_frames(frame_queue)
+    env_fns = [lambda rank=rank: make_env(path, rank, num_envs, seed, yolo, survey, skip_ids,
+                                          frame_queue if rank == 0 else None)
+               for rank in range(num_envs)]
+    return SubprocVecEnv(env_fns, start_method=start_method)
+
 def train(save_path: str, stops_path: str, model_path = None):
     """
     Train the model, either a fresh version or from a saved path.
@@ -33,12 +79,20 @@ def train(save_path: str, stops_path: str, model_path = None):
     :param save_path: Path to save the model to, including checkpoints.
     :param load_path: If resuming training, specify existsing model path.
     """
-    vec_env = DummyVecEnv([lambda: make_env(stops_path)])
+    vec_env = make_vec_env(stops_path)
     vec_env = VecFrameStack(vec_env, n_stack=S.stack_sz)
 
+    # Rollouts keep each frame once and rebuild stacks on sampling
+    buffer_args = dict(
+        rollout_buffer_class=FrameStackRolloutBuffer,
+        rollout_buffer_kwargs=dict(stack_sz=S.stack_sz)
+    )
+
     # Resume training 
     if model_path:
-        model = PPO.load(model_path, env=vec_env)
+        model = PPO.load(model_path, env=vec_env, **buffer_args)
+        if S.seed is not None:
+            model.set_random_seed(S.seed)
     
     else:
         # Create PPO model
@@ -51,7 +105,9 @@ def train(save_path: str, stops_path: str, model_path = None):
             n_steps=2048,
             policy_kwargs=dict(normalize_images=False),
             tensorboard_log=S.log_dir,
-            device="cuda:0"
+            device=S.device,
+            seed=S.seed,
+            **buffer_args
         )
 
     # Creates checkpoint files while training and tensorboard log
@@ -66,7 +122,7 @@ def train(save_path: str, stops_path: str, model_path = None):
     model.set_logger(logger)
 
     # Begin learning
-    model.learn(total_timesteps=51200, callback=checkpoint_callback)
+    model.learn(total_timesteps=51200, callback=[checkpoint_callback, TimingCallback()])
     
     # Save model, close gym
     model.save(save_path)
@@ -88,8 +144,72 @@ def infer(model_path: str, stops_path: str, num_episodes:int):
             obs, reward, done, info = vec_env.step(action)
             done = done[0]
 
+def survey(model_path: str, stops_path: str, out_path: str = "survey.jsonl", num_envs: int = S.num_envs):
+    """
+    Score every stop in a catalog with a trained model, several stops at a time.
+
+    Each finished stop is appended to out_path as {stop_id: entry} in the all_scores.json schema,
+    so a crashed survey picks up where it left off. Use compile_survey to get the final JSON.
+    """
+    # Resume: skip whatever is already written
+    done_ids = set(read_survey(out_path))
+    if done_ids:
+        print(f"[Survey] Resuming, {len(done_ids)} stops already scored")
+
+    # One stop per env at a time, a single batched predict for all of them each step
+    vec_env = make_vec_env(stops_path, num_envs, survey=True, skip_ids=done_ids)
+    vec_env = VecFrameStack(vec_env, n_stack=S.stack_sz)
+    model = PPO.load(model_path, env=vec_env)
+
+    scored = 0
+    start = time.time()
+    obs = vec_env.reset()
+    with open(out_path, "a", encoding="utf-8") as out:
+        while True:
+            actions, _ = model.predict(obs, deterministic=True)
+            obs, _, _, infos = vec_env.step(actions)
+
+            # Write each stop as soon as it's done
+            for info in infos:
+                if "stop_record" in info:
+                    # Grouped stops share one episode but each gets its own line
+                    for stop_id, entry in info["stop_record"]:
+                        out.write(json.dumps({stop_id: entry}) + "\n")
+                    out.flush()
+                    scored += len(info["stop_record"])
+                    if scored % 50 < len(info["stop_record"]):
+                        rate = scored / (time.time() - start) * 3600
+                        print(f"[Survey] {scored} stops scored, {rate:.0f} stops/hour")
+
+            # Every worker ran out of stops
+            if all(info.get("exhausted") for info in infos):
+                break
+    vec_env.close()
+
+    hours = (time.time() - start) / 3600
+    print(f"[Survey] Done: {scored} stops in {hours:.2f}h ({scored / max(hours, 1e-9):.0f} stops/hour)")
+
+def read_survey(path: str):
+    """ {stop_id: entry} from a survey file, ignoring a half-written last line. """
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                results.update(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return results
+
+def compile_survey(survey_path: str, scores_path: str):
+    """ Turn a survey file into a single all_scores.json style file. """
+    with open(scores_path, "w", encoding="utf-8") as f:
+        json.dump(read_survey(survey_path), f, indent=2)
+
 if __name__ == "__main__":
     start_server(port=5000)
 
     train("models/PPO", "assets/all_scores.json", "TEMP")
-    # infer("53248", "assets/all_stops.csv", 200)
\ No newline at end of file
+    # infer("53248", "assets/all_stops.csv", 200)
+    # survey("53248", "assets/all_stops.csv", f"{S.save_folder}/survey.jsonl")
\ No newline at end of file
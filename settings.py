@@ -9,6 +9,17 @@ class S:
     num_classes = 5
     yolo_path = "assets/YOLO.pt"
     secondary_boost = .35               # How much of the secondary amenities' scores are kept 
+    detector_conf = .25                 # Min box confidence
+    detector_iou = .7                   # NMS IoU threshold
+    detector_backend = "ultralytics"    # "ultralytics", "onnx" or "torchscript" (python -m resources.exported_detector, needs feature_source = "tapped")
+    export_path = "assets/YOLO_export"  # Exported graph path (extension added per format)
+    detector_threads = 0                # CPU threads for the exported graph (0 = runtime default)
+    detector_precision = "fp32"         # "fp32", "int8" (onnx) or "bf16" (torchscript)
+    feature_source = "legacy"           # "legacy" (separate BGR backbone pass, what 53248 / Scripted_24750 were trained on) or "tapped" (free, from the detection pass; needs retraining)
+    detector_batch = 1                  # Frames per forward pass in StopDetector.run_batch (size of the preallocated input buffer)
+    jpeg_decoder = "cv2"                # "cv2" or "turbojpeg" (PyTurboJPEG, falls back to cv2 if missing)
+    reduced_decode = True               # Decode frames at 1/2, 1/4 or 1/8 scale when img_size is that much smaller
+    decode_cache_size = 4               # Decoded frames kept per env, keyed by their JPEG bytes
 
     """ RL Properties """
     img_size = (640,640)                # Size that images are compressed to before plugged into YOLO 
@@ -30,6 +41,13 @@ class S:
     multi_persp_reward = .3             # Points for having found multiple perpsectives of the stop
     num_persp_rewarded = 4              # Max number of perspectives the model is rewarded for finding
     stack_sz = 30
+    device = "auto"                     # Torch device for PPO ("auto" picks CUDA when there is one)
+    num_envs = 1                        # Env worker processes, each gets its own slice of the stops
+    torch_threads_per_env = 1           # Torch CPU threads per worker when num_envs > 1
+    seed = None                         # Fixes the stop order, positive scrambling and PPO (None picks a new one each run)
+    stop_order = "random"               # "random" is a plain shuffle, "local" walks shuffled stops neighbourhood by neighbourhood (best with num_envs > 1)
+    locality_precision = 6              # Geohash length of a neighbourhood for "local" (6 is ~1.2km x 0.6km)
+    dedup_radius = 15                   # Surveys: stops within this many meters share one episode (0 to keep them all)
 
     """ RPPO Properties """
     bbs_kept = 3                        # How many of the highest conf bounding boxes will be kept per frame
@@ -45,13 +63,50 @@ class S:
 
     """ Logging & Screenshots """
     save_screenshots = True            # Save screenshots of "best evidence" of each bus stop?
-    annotate_screenshots = False       # Run YOLO model to annotate screenshots?
+    annotate_screenshots = False       # Draw the detector's boxes on screenshots?
+    screenshot_boxes = 10              # Boxes kept per view (incl. in the feature store) for annotating screenshots
+    writer_max_pending = 16            # Screenshots etc. queued for the background writer before the env waits on it
+    record_trajectories = False        # Stream every step to {log_dir}trajectories/ (resources/trajectory.py)
+    trajectory_chunk = 4096            # Steps per compressed .npz chunk
     save_folder = "runs"
+    log_fsync_every = 10               # Episode log is fsynced every this many flushes
+    api_flush_interval = 30            # Seconds between API call count flushes (api_calls.json)
+    timing_window = 4096               # Most recent samples kept per step stage for latency percentiles
+    profile_every = 0                  # Profile every Nth env step (0 = off), dumped to {log_dir}profiles/
+    profile_backend = "cprofile"       # "cprofile" (.prof) or "torch" (chrome trace)
 
 
     """ API Settings """
     rotate_amt = 45
 
+    """ Backend Settings """
+    backend = "live"                    # "live", "record" (live + archive every response) or "replay" (archive only)
+    archive_path = "assets/archive.db"  # Where record writes and replay reads
+    replay_strict = False               # Replay raises on anything the archive doesn't have, instead of a blank stand-in
+
+    """ HTTP Settings """
+    requests_per_sec = 20               # Token bucket rate shared by all requests in a process (0 = unlimited)
+    request_burst = 10                  # How many requests can go out back to back before throttling kicks in
+    request_timeout = 10                # Seconds before a request is abandoned
+    max_retries = 6                     # Retries on timeouts, 429s and 5xxs
+    backoff_base = .5                   # First retry waits up to this long, doubling each time
+    backoff_cap = 30                    # Longest wait between retries
+    http_pool_size = 16                 # Keep-alive connections per host
+
+    """ Prefetch Settings """
+    prefetch = True                     # Pull likely next views in the background while the policy runs
+    prefetch_workers = 4                # Threads doing the speculative pulls
+    prefetch_max_pending = 8            # Cap on queued + running speculative pulls
+
+    """ Cache Settings """
+    use_cache = True                    # Keep pulled images (and metadata) on disk between runs
+    cache_dir = "cache"                 # Shared by every process / run
+    image_cache_mb = 2048               # LRU size cap for cached images
+    heading_quantum = 1                 # Headings are snapped to this many degrees for requests & cache keys
+    meta_grid = 1e-5                    # Lat/lng grid (degrees, ~1m) that location metadata queries are cached on
+    street_dir_precision = 8            # Geohash length street bearings are cached at (8 is ~38m x 19m)
+    use_feature_store = True            # Reuse detector output for views seen before (per set of weights)
+
     """ Don't Touch """
     bb_dim = 4                          # Vector containing bounding box cords, area, class
     features_dim = 512                  # Vector containing YOLO features
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Tests import modules the same way the scripts do, from the repo root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
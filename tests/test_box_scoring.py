@@ -0,0 +1,77 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from settings import S
+
+pytest.importorskip("torch")
+pytest.importorskip("ultralytics")
+pytest.importorskip("stable_baselines3")
+from resources.stop_detector import StopDetector
+
+NAMES = {0: "sign", 1: "shelter", 2: "bench", 3: "route info", 4: "trash can"}
+
+@pytest.fixture
+def detector():
+    # Only the class lookups are needed, not the weights
+    detector = StopDetector.__new__(StopDetector)
+    detector.names = NAMES
+    detector.labels = np.array([NAMES[i] for i in range(len(NAMES))], dtype=object)
+    detector.primary = np.array([label in {"shelter", "sign"} for label in detector.labels])
+    return detector
+
+def random_output(rng, n):
+    """ A stand-in Results with n random boxes, sorted by confidence like YOLO's. """
+    corners = np.sort(rng.random((n, 2, 2)), axis=1)
+    xyxy = np.stack([corners[:, 0, 0], corners[:, 0, 1], corners[:, 1, 0], corners[:, 1, 1]], axis=1)
+    conf = np.sort(rng.random(n))[::-1]
+    cls = rng.integers(0, len(NAMES), n)
+    table = np.column_stack([xyxy, conf, cls]).astype(np.float32)
+    return SimpleNamespace(box_table=table, pooled_feats=rng.random(S.features_dim).astype(np.float32))
+
+def loop_score_output(output):
+    """ The original per-box score_output. """
+    if len(output.box_table) == 0:
+        return 0.0, False, None, 0
+    primary_score = secondary_score = 0.0
+    found = False
+    boxes = {}
+    biggest_box = 0
+    for x1, y1, x2, y2, conf, cls in output.box_table:
+        label = NAMES[int(cls)]
+        boxes[label] = float(conf)
+        if label in {"shelter", "sign"}:
+            primary_score = max(primary_score, float(conf))
+            found = True
+            biggest_box = max(biggest_box, float((x2 - x1) * (y2 - y1)))
+        else:
+            secondary_score += float(conf)
+    secondary_score = min(secondary_score, 1.0 - primary_score)
+    return min(primary_score + S.secondary_boost * secondary_score, 1.0), found, boxes, biggest_box
+
+def loop_extract_features(output):
+    """ The original per-box extract_features, minus the backbone pass. """
+    det_vecs = np.zeros((S.bbs_kept, 4 + S.num_classes))
+    found = False
+    for i, (x1, y1, x2, y2, conf, cls) in enumerate(output.box_table[:S.bbs_kept]):
+        if NAMES[int(cls)] in {"shelter", "sign"}:
+            found = True
+        det_vecs[i, :4] = (x1 + x2) / 2, (y1 + y2) / 2, (x2 - x1) * (y2 - y1), conf
+        det_vecs[i, 4 + int(cls)] = 1.0
+    return np.concatenate([output.pooled_feats, det_vecs.flatten()]), found
+
+@pytest.mark.parametrize("n", [0, 1, 2, S.bbs_kept, S.bbs_kept + 3, 20])
+def test_vectorized_matches_loops(detector, n):
+    rng = np.random.default_rng(n)
+    for _ in range(20):
+        output = random_output(rng, n)
+        conf, found, boxes, box_sz = detector.score_output(output)
+        ref_conf, ref_found, ref_boxes, ref_box_sz = loop_score_output(output)
+        assert conf == pytest.approx(ref_conf)
+        assert found == ref_found
+        assert boxes == (pytest.approx(ref_boxes) if ref_boxes else ref_boxes)
+        assert box_sz == pytest.approx(ref_box_sz)
+
+        feats, feats_found = detector.extract_features(output)
+        ref_feats, ref_found = loop_extract_features(output)
+        np.testing.assert_allclose(feats, ref_feats, atol=1e-6)
+        assert feats_found == ref_found
@@ -0,0 +1,62 @@
+import json
+import pytest
+from settings import S
+from resources.catalog import Catalog, compile_catalog, FALSE_NEGATIVE, POSITIVE
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(S, "cache_dir", str(tmp_path / "cache"))
+
+def test_compile_all_scores():
+    path = "assets/all_scores.json"
+    with open(path) as f:
+        scores = json.load(f)
+    catalog = Catalog(compile_catalog(path))
+    assert len(catalog) == len(scores)
+
+    # Every row round-trips, including the stops with a null place name
+    for i, (stop_id, score) in enumerate(scores.items()):
+        stop = catalog.stop(i)
+        assert stop.stop_id == stop_id
+        assert stop.place_name == (score["gmaps_place_name"] or "")
+        assert stop.og_lat == score["latitude"] and stop.og_lng == score["longitude"]
+        assert catalog.flags[i] == (POSITIVE if score["amenity_scores"] else FALSE_NEGATIVE)
+
+def test_compile_all_stops():
+    path = "assets/all_stops.csv"
+    catalog = Catalog(compile_catalog(path))
+    with open(path, encoding="utf-8") as f:
+        rows = sum(1 for _ in f) - 1
+    assert len(catalog) == rows
+    assert not catalog.flags.any()
+    assert not catalog.ignored().any()
+
+def test_load_stops_csv_with_positives_requested():
+    # Training asks for positives, CSV catalogs don't have any
+    from resources.loader import StopLoader
+    loader = StopLoader(None)
+    loader.load_stops("assets/all_stops.csv", shuffle_stops=True, num_positives=2000, seed=0)
+    with open("assets/all_stops.csv", encoding="utf-8") as f:
+        rows = sum(1 for _ in f) - 1
+    assert len(loader.stops) == rows
+    assert loader.stops[0].stop_id
+
+def test_load_stops_json_positives_capped():
+    from resources.loader import StopLoader
+    with open("assets/all_scores.json") as f:
+        scores = json.load(f)
+    positives = sum(1 for score in scores.values() if score["amenity_scores"])
+    loader = StopLoader(None)
+    loader.load_stops("assets/all_scores.json", num_positives=10**6, seed=0)
+    assert len(loader.stops) == len(scores)
+    assert sum(not stop.false_negative for stop in loader.stops) == positives
+
+def test_finished_survey_loads_nothing():
+    # Re-running a survey where every stop is already done
+    from resources.loader import StopLoader
+    with open("assets/all_scores.json") as f:
+        done = set(json.load(f))
+    loader = StopLoader(None, survey=True)
+    loader.load_stops("assets/all_scores.json", shuffle_stops=False, skip_ids=done, dedup=True)
+    assert len(loader.stops) == 0
+    assert loader.exhausted()
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import pytest
+from settings import S
+
+torch = pytest.importorskip("torch")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("ultralytics")
+pytestmark = pytest.mark.skipif(not os.path.exists(S.yolo_path), reason=f"needs weights at {S.yolo_path}")
+
+from resources.stop_detector import StopDetector
+
+def baseline_features(detector, img):
+    """ The original extract_features preprocessing and backbone pass. """
+    img_resized = cv2.resize(img, S.img_size).astype(np.float32) / 255.0
+    img_tensor = torch.tensor(np.transpose(img_resized, (2, 0, 1)), dtype=torch.float32).unsqueeze(0)
+    with torch.no_grad():
+        features = detector.model.model.model[:11](img_tensor.to(next(detector.model.model.parameters()).device))
+    return features.mean(dim=[2, 3]).squeeze().cpu().numpy()
+
+@pytest.fixture(scope="module")
+def detector():
+    return StopDetector()
+
+@pytest.fixture(scope="module")
+def frame():
+    return np.random.default_rng(0).integers(0, 256, (640, 640, 3), dtype=np.uint8)
+
+def test_legacy_path_matches_baseline(detector, frame, monkeypatch):
+    monkeypatch.setattr(S, "feature_source", "legacy")
+    feats = detector.run(frame).pooled_feats
+    np.testing.assert_allclose(feats, baseline_features(detector, frame), rtol=1e-4, atol=1e-5)
+
+def test_tapped_path_sees_rgb_input(detector, frame, monkeypatch):
+    monkeypatch.setattr(S, "feature_source", "tapped")
+    tapped = detector.run(frame).pooled_feats
+    legacy = baseline_features(detector, frame)
+
+    # Same backbone, but the detection pass is fed RGB, so it only matches the old path on the flipped frame
+    np.testing.assert_allclose(tapped, baseline_features(detector, frame[..., ::-1].copy()), rtol=1e-3, atol=1e-4)
+    assert not np.allclose(tapped, legacy, rtol=1e-3, atol=1e-4)
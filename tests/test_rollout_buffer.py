@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("stable_baselines3")
+from gymnasium import spaces
+from resources.rollout_buffer import FrameStackRolloutBuffer
+
+STACK, FRAME_DIM, N_ENVS, STEPS = 4, 3, 2, 32
+
+def stacked_rollout(rng, done_prob=.2):
+    """ Observations and episode starts the way VecFrameStack hands them out, warm stacks included. """
+    stack = np.zeros((N_ENVS, STACK, FRAME_DIM), dtype=np.float32)
+
+    # A few steps before the rollout, so it starts with frames already stacked
+    for _ in range(2):
+        stack = np.roll(stack, -1, axis=1)
+        stack[:, -1] = rng.random((N_ENVS, FRAME_DIM))
+
+    obs, starts = [], []
+    start = np.zeros(N_ENVS, dtype=np.float32)
+    for _ in range(STEPS):
+        obs.append(stack.reshape(N_ENVS, -1).copy())
+        starts.append(start)
+        done = rng.random(N_ENVS) < done_prob
+        stack = np.roll(stack, -1, axis=1)
+        stack[:, -1] = rng.random((N_ENVS, FRAME_DIM))
+
+        # VecFrameStack clears everything but the reset frame
+        stack[done, :-1] = 0
+        start = done.astype(np.float32)
+    return np.array(obs), np.array(starts)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rebuilt_stacks_match_vec_frame_stack(seed):
+    rng = np.random.default_rng(seed)
+    obs, starts = stacked_rollout(rng)
+    buffer = FrameStackRolloutBuffer(STEPS, spaces.Box(-np.inf, np.inf, (STACK * FRAME_DIM,), np.float32),
+                                     spaces.Discrete(4), device="cpu", n_envs=N_ENVS, stack_sz=STACK)
+    for step in range(STEPS):
+        # Values carry each sample's flattened (env-major) index, to undo the shuffle in get()
+        index = torch.arange(N_ENVS, dtype=torch.float32) * STEPS + step
+        buffer.add(obs[step], np.zeros((N_ENVS, 1)), np.zeros(N_ENVS), starts[step], index, torch.zeros(N_ENVS))
+
+    expected = obs.swapaxes(0, 1).reshape(N_ENVS * STEPS, -1)
+    for batch in buffer.get(batch_size=16):
+        index = batch.old_values.numpy().astype(int)
+        np.testing.assert_array_equal(batch.observations.numpy(), expected[index])